@@ -0,0 +1,99 @@
+import math
+import cv2
+from layout import WatermarkLayout, TextWatermark
+from watermark_layer import LayerCache
+
+# Text colours a layout is recoloured to when it is unreadable where it lands
+TEXT_TONES = {'dark': (0, 0, 0), 'light': (255, 255, 255)}
+
+
+class AutoPlacement:
+    """ Move a watermark to the calmest, most legible corner or band of each image.
+
+    The compiled layer is tried at its own place and mirrored into the other corners and the centre
+    of the top and bottom bands. Each candidate is scored on a small luminance sample of the image
+    using integral images, so a region costs four lookups and scoring an image takes a few hundredths
+    of a millisecond at any resolution: busyness is the standard deviation of the luminance under the
+    layer, and contrast is how far its mean is from the watermark's own luminance. The layout only
+    moves when another place scores better by `stay_bias`, and its text is recoloured black or white
+    when even the best place has less than `min_contrast`.
+    """
+
+    def __init__(self, sample_width=96, stay_bias=0.1, min_contrast=0.25, max_layouts=32):
+        self.sample_width = sample_width
+        self.stay_bias = stay_bias
+        self.min_contrast = min_contrast
+        self.layouts = LayerCache(max_layouts)
+
+    def sample(self, image):
+        """ Get the summed-area tables of a small luminance sample of an image, and its scale. """
+        height, width = image.shape[:2]
+        scale = min(self.sample_width / width, 1)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        # A bilinear sample keeps fine texture that an area average would smooth away, and costs nothing
+        luminance = cv2.cvtColor(cv2.resize(image, size), cv2.COLOR_BGR2GRAY)
+        sums, squares = cv2.integral2(luminance)
+        return sums, squares, size[0] / width
+
+    def region_stats(self, sums, squares, x0, y0, x1, y1):
+        """ Get the mean and standard deviation of the sample inside a region, from its integral images. """
+        count = (x1 - x0) * (y1 - y0)
+        total = sums[y1, x1] - sums[y0, x1] - sums[y1, x0] + sums[y0, x0]
+        square_total = squares[y1, x1] - squares[y0, x1] - squares[y1, x0] + squares[y0, x0]
+        mean = total / count
+        return mean, max(square_total / count - mean * mean, 0) ** 0.5
+
+    def candidates(self, image_size, rect):
+        """ Get the origins that move a layer rect into each corner and band, its own place first. """
+        width, height = image_size
+        x, y, rect_width, rect_height = rect
+        # Mirror the layout's own margins into the other corners
+        right = width - x - rect_width
+        top = height - y - rect_height
+        origins = [(0, 0)]
+        for origin_x in (0, (width - rect_width) // 2 - x, right - x):
+            for origin_y in (0, top - y):
+                if (origin_x, origin_y) not in origins:
+                    origins.append((origin_x, origin_y))
+        return origins
+
+    def place(self, image, layer):
+        """ Choose where to apply a layer on an image.
+
+        Returns the origin to apply the layer at and the text tone to recolour the layout to, which is
+        None when the text is legible as it is.
+        """
+        height, width = image.shape[:2]
+        sums, squares, scale = self.sample(image)
+        sample_height, sample_width = sums.shape[0] - 1, sums.shape[1] - 1
+        x, y, rect_width, rect_height = layer.rect
+        best = None
+        for origin in self.candidates((width, height), layer.rect):
+            x0 = min(max(int((x + origin[0]) * scale), 0), sample_width - 1)
+            y0 = min(max(int((y + origin[1]) * scale), 0), sample_height - 1)
+            x1 = min(max(math.ceil((x + origin[0] + rect_width) * scale), x0 + 1), sample_width)
+            y1 = min(max(math.ceil((y + origin[1] + rect_height) * scale), y0 + 1), sample_height)
+            mean, deviation = self.region_stats(sums, squares, x0, y0, x1, y1)
+            contrast = abs(mean - layer.luminance) / 255
+            cost = deviation / 128 + 1 - contrast - (self.stay_bias if origin == (0, 0) else 0)
+            if best is None or cost < best[0]:
+                best = (cost, origin, mean, contrast)
+        _, origin, mean, contrast = best
+        tone = None
+        if contrast < self.min_contrast:
+            tone = 'light' if mean < 128 else 'dark'
+        return origin, tone
+
+    def recolor(self, layout, tone):
+        """ Get the layout with its text in the given tone, or None if it has no text to recolour. """
+        if not any(isinstance(watermark, TextWatermark) for watermark in layout.objects):
+            return None
+
+        def recolored():
+            color = TEXT_TONES[tone]
+            objects = [TextWatermark(watermark.text, color, watermark.font, watermark.size, watermark.bold,
+                                     watermark.position) if isinstance(watermark, TextWatermark) else watermark
+                       for watermark in layout.objects]
+            return WatermarkLayout(objects, layout.canvas_size, layout.scalar)
+
+        return self.layouts.get_or_compile((layout.content_hash, tone), recolored)
@@ -0,0 +1,223 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from cv_manager import CVManager
+from image_encoder import ImageEncoder, ENCODER_FORMATS
+from layout import WatermarkLayout
+from rendition import Rendition
+from auto_placement import AutoPlacement
+from export_manifest import ExportManifest
+from instrumentation import Instrumentation
+from pipeline import bounded_map
+from frame_pipeline import run_pipeline
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff')
+
+# Per-process worker state, filled once by init_worker
+worker = {}
+
+
+def collect_images(source):
+    """ Collect image paths from a directory or a glob pattern. """
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source)]
+    else:
+        paths = glob.glob(source)
+    return sorted(path for path in paths if path.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def image_name(path):
+    """ Get the output name of an image the same way the image list does. """
+    return os.path.basename(path).split('.')[0]
+
+
+def available_cores():
+    """ Get the number of cores this process is allowed to run on. """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def init_worker(layout, folder, encoder_settings, native=False, tile_pixels=None, instruments=None, auto_place=False):
+    """ Keep the watermark layout and set up the encoder once per worker process.
+
+    `instruments` are the (enabled, profile, trace_memory) settings of the worker's Instrumentation.
+    """
+    cv = CVManager(tile_pixels=tile_pixels)
+    if instruments:
+        cv.instruments = Instrumentation(*instruments)
+    if auto_place:
+        cv.auto_placement = AutoPlacement()
+    worker.update(cv=cv, layout=layout, folder=folder, encoder=ImageEncoder(**encoder_settings), native=native)
+
+
+def watermark_file(path):
+    """ Load, watermark and save a single image inside a worker process.
+
+    Returns the path, or None if the image could not be read, and the worker's instrumentation
+    snapshot for the image, or None if instrumentation is off.
+    """
+    cv = worker['cv']
+    with cv.instruments.traced(), cv.instruments.profiled():
+        name = cv.export_image(worker['folder'], path, image_name(path), worker['layout'], worker['encoder'],
+                               worker['native'])
+    return path if name else None, cv.instruments.drain() if cv.instruments.enabled else None
+
+
+def pipeline_stages(jobs):
+    """ Split worker processes into (decode, render, encode) stages, watermarking is the cheapest of the three. """
+    decoders = max(1, jobs // 2)
+    return decoders, max(1, jobs // 8), max(1, jobs - decoders)
+
+
+def run_batch(paths, layout, folder, jobs=None, window=None, encoder_settings=None, native=False, tile_pixels=None,
+              instruments=None, pipeline=False, auto_place=False, slot_pixels=None):
+    """ Watermark every path on a process pool and return the number of (saved, already up to date) images.
+
+    The layout is sent to each worker once when the pool starts, not with every image.
+
+    At most `window` images are in flight at once (default: two per worker), so memory use does not
+    grow with the size of the batch. Images above `tile_pixels` are memory-mapped and tiled, so it
+    does not grow with the size of a single image either.
+
+    The folder's export manifest is used to skip outputs that are already up to date and to write
+    identical sources only once, and it is updated as images are saved so an interrupted batch can
+    be resumed. Stage timings of the workers are collected into `instruments` if it is enabled.
+
+    With `pipeline` decoding, watermarking and encoding run on processes of their own that pass
+    frames through shared memory (see frame_pipeline), instead of each worker doing all three, with
+    frame slots of at most `slot_pixels`.
+    Worker stage timings are not collected then. `auto_place` turns on AutoPlacement in the workers.
+    """
+    jobs = jobs or available_cores()
+    window = window or jobs * 2
+    encoder_settings = encoder_settings or {}
+    encoder = ImageEncoder(**encoder_settings)
+    # Set up like the workers, for the settings their outputs are made with
+    cv = CVManager(tile_pixels=tile_pixels)
+    if auto_place:
+        cv.auto_placement = AutoPlacement()
+    manifest = ExportManifest(folder)
+    render, copies, skipped = manifest.plan(((path, image_name(path)) for path in paths), layout.content_hash,
+                                            {**encoder.settings, **cv.placement_settings, 'native': native},
+                                            encoder.extension)
+    keys = {path: key for path, _, key in render}
+    saved = 0
+    settings = (instruments.enabled, instruments.profile, instruments.trace_memory) if instruments else None
+    initargs = (layout, folder, encoder_settings, native, tile_pixels, settings, auto_place)
+    try:
+        if render and pipeline:
+            items = [(path, image_name(path)) for path in keys]
+            for path in run_pipeline(items, layout, folder, encoder_settings, native, tile_pixels,
+                                     pipeline_stages(jobs), auto_place, slot_pixels):
+                if path:
+                    manifest.record(image_name(path), encoder.extension, keys[path])
+                    saved += 1
+        elif render:
+            with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=initargs) as pool:
+                for path, snapshot in bounded_map(pool, watermark_file, list(keys), window):
+                    if snapshot:
+                        instruments.merge(snapshot)
+                    if path:
+                        manifest.record(image_name(path), encoder.extension, keys[path])
+                        saved += 1
+        saved += sum(1 for name, source_name, key in copies
+                     if manifest.copy(name, source_name, encoder.extension, key))
+    finally:
+        manifest.save()
+    return saved, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Watermark a batch of images without the PyMark window.')
+    parser.add_argument('source', help='input directory or glob pattern, e.g. "photos/*.jpg"')
+    parser.add_argument('layout', help='watermark layout file saved from PyMark')
+    parser.add_argument('-o', '--output', default='.', help='folder to create the PyMark output folder in')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: available cores)')
+    parser.add_argument('-w', '--window', type=int, default=None,
+                        help='images in flight at once (default: two per worker)')
+    parser.add_argument('-f', '--format', default=None, choices=[*ENCODER_FORMATS, 'jpg'],
+                        help='output format (default: png)')
+    parser.add_argument('-q', '--quality', type=int, default=None,
+                        help='JPEG/WebP quality 0-100 or PNG compression level 0-9')
+    parser.add_argument('-r', '--rendition', action='append', default=[], metavar='NAME:SIZE[:FORMAT[:QUALITY[:SCALE]]]',
+                        help='write this rendition of every image to the NAME subfolder, SIZE being WIDTHxHEIGHT or '
+                             'full, e.g. web:1600x1600:jpeg:85 (repeatable, replaces --format, --quality and '
+                             '--native)')
+    parser.add_argument('--native', action='store_true',
+                        help='keep the source resolution and only redraw the watermarked region')
+    parser.add_argument('--auto-place', action='store_true',
+                        help='move each watermark to a calm corner or band, or recolour its text, to keep it legible')
+    parser.add_argument('--tile-megapixels', type=float, default=None,
+                        help='memory-map and tile images larger than this (default: 100)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='decode, watermark and encode on separate processes sharing frames in memory')
+    parser.add_argument('--slot-megapixels', type=float, default=None,
+                        help='largest image a --pipeline frame slot holds, bigger ones are exported on their own '
+                             '(default: fits 90%% of the batch)')
+    parser.add_argument('--fresh', action='store_true',
+                        help='export into a new PyMark_N folder instead of updating the PyMark folder')
+    parser.add_argument('--stats', action='store_true', help='print per-stage timings as JSON at the end')
+    parser.add_argument('--profile', action='store_true', help='add the top functions from cProfile to the stats')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='add the peak traced allocation per image to the stats')
+    args = parser.parse_args(argv)
+    if args.rendition:
+        # Renditions are exported on threads by CVManager.export_renditions, which has no use for these
+        ignored = [flag for flag, value in (('--format', args.format), ('--quality', args.quality),
+                                            ('--native', args.native), ('--window', args.window),
+                                            ('--pipeline', args.pipeline), ('--slot-megapixels', args.slot_megapixels))
+                   if value is not None and value is not False]
+        if ignored:
+            parser.error(f'--rendition cannot be combined with {", ".join(ignored)}')
+    try:
+        encoder_settings = ImageEncoder(args.format or 'png', args.quality).settings
+        renditions = Rendition.parse_all(args.rendition)
+    except ValueError as error:
+        parser.error(str(error))
+
+    try:
+        layout = WatermarkLayout.load(args.layout)
+    except (OSError, ValueError) as error:
+        parser.error(f'cannot load the layout: {error}')
+    paths = collect_images(args.source)
+    if not paths:
+        print(f'No images found in {args.source}', file=sys.stderr)
+        return 1
+    folder = CVManager().create_folder(args.output, reuse=not args.fresh)
+    start = time.perf_counter()
+    tile_pixels = args.tile_megapixels * 10 ** 6 if args.tile_megapixels else None
+    instruments = Instrumentation(args.stats, args.profile, args.trace_memory)
+    if renditions:
+        # Every source is decoded once for all renditions, on threads as OpenCV releases the GIL
+        cv = CVManager(tile_pixels=tile_pixels)
+        cv.instruments = instruments
+        if args.auto_place:
+            cv.auto_placement = AutoPlacement()
+        names, failed = cv.export_renditions(folder, paths, [image_name(path) for path in paths], layout,
+                                             renditions, args.jobs or available_cores())
+        elapsed = time.perf_counter() - start
+        print(f'{len(names)} outputs of {len(paths)} images in {len(renditions)} renditions saved to {folder} '
+              f'in {elapsed:.2f}s, {failed} failed')
+        if instruments.enabled:
+            print(json.dumps({'images': len(paths), 'saved': len(names), 'failed': failed,
+                              'seconds': round(elapsed, 3), **instruments.summary()}, indent=2))
+        return 1 if failed else 0
+    saved, skipped = run_batch(paths, layout, folder, args.jobs, args.window, encoder_settings, args.native,
+                               tile_pixels, instruments, args.pipeline, args.auto_place,
+                               args.slot_megapixels * 10 ** 6 if args.slot_megapixels else None)
+    elapsed = time.perf_counter() - start
+    print(f'{saved}/{len(paths)} images saved to {folder} in {elapsed:.2f}s '
+          f'({saved / elapsed if elapsed else 0:.1f} images/sec), {skipped} already up to date')
+    if instruments.enabled:
+        print(json.dumps({'images': len(paths), 'saved': saved, 'skipped': skipped, 'seconds': round(elapsed, 3),
+                          **instruments.summary()}, indent=2))
+    return 0 if saved + skipped == len(paths) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+import cv2
+import numpy as np
+from cv_manager import CVManager
+from image_encoder import ImageEncoder
+from image_stack import ImageStack
+from layout import WatermarkLayout, TextWatermark, ImageWatermark
+
+IMAGE_SIZES = {'vga': (640, 480), 'hd': (1280, 720), 'fhd': (1920, 1080), 'qhd': (2560, 1440),
+               '4k': (3840, 2160), '8k': (7680, 4320)}
+LAYOUTS = ('text', 'image', 'mixed')
+CANVAS_SIZE = (450, 150)
+# Same-size images drawn together by the draw_batch stage
+BATCH_IMAGES = 8
+
+
+def synthetic_image(width, height, seed=0):
+    """ Create a deterministic photo-like test image: smooth gradients plus a little noise. """
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    image = np.dstack(((x + y) / 2 + np.zeros_like(y), np.abs(x - y) + np.zeros_like(x), 255 - (x + y) / 2))
+    image += rng.normal(0, 8, image.shape).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def synthetic_layout(kind):
+    """ Create watermark objects like the editor does, for a text, image or mixed layout. """
+    logo = synthetic_image(120, 60, seed=1)
+    text_objects = [(TextWatermark('PYMARK', (255, 255, 255), 0, 2, True), ((40, 40), (160, 50))),
+                    (TextWatermark('all rights reserved', (0, 0, 0), 2, 1, False), ((40, 100), (190, 105)))]
+    image_objects = [(ImageWatermark(logo), ((250, 40), (370, 100))),
+                     (ImageWatermark(logo[:40, :80].copy()), ((300, 100), (380, 140)))]
+    if kind == 'text':
+        return text_objects
+    if kind == 'image':
+        return image_objects
+    return [text_objects[0], image_objects[0], text_objects[1], image_objects[1]]
+
+
+def measure(function, repeat):
+    """ Time a function over `repeat` runs, then measure its peak traced allocation in one extra run. """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'runs': repeat, 'min_ms': round(min(times), 4), 'median_ms': round(statistics.median(times), 4),
+            'ops_per_sec': round(1000 / statistics.median(times), 2) if min(times) else None,
+            'peak_alloc_mb': round(peak / 2 ** 20, 3)}
+
+
+def qt_to_pixmap():
+    """ Get UIManager.to_pixmap on an offscreen Qt platform, or None when Qt is not available. """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    try:
+        from PyQt5.QtWidgets import QApplication
+        from ui_manager import UIManager
+    except ImportError:
+        return None
+    global qt_app
+    qt_app = QApplication.instance() or QApplication([])
+    return UIManager().to_pixmap
+
+
+def benchmark_stages(sizes, repeat):
+    """ Time each watermarking stage on synthetic images of every size. """
+    cv = CVManager()
+    stack = ImageStack()
+    to_pixmap = qt_to_pixmap()
+    results = []
+
+    def add(stage, size, function, **details):
+        results.append({'stage': stage, 'size': size, **details, **measure(function, repeat)})
+
+    # Editor stages run on the fixed-size watermark canvas
+    canvas = np.full((150, 450, 3), 255, dtype=np.uint8)
+    logo = synthetic_image(800, 400, seed=2)
+    add('fitImage', '450x150', lambda: cv.fitImage(logo, CANVAS_SIZE, canvas.copy(), gap=(40, 40)))
+    add('mark_selection', '450x150', lambda: cv.mark_selection(canvas, ((60, 30), (390, 120))))
+    if to_pixmap:
+        add('to_pixmap', '450x150', lambda: to_pixmap(canvas))
+        preview = synthetic_image(600, 300)
+        add('to_pixmap', '600x300', lambda: to_pixmap(preview))
+
+    for name in sizes:
+        width, height = IMAGE_SIZES[name]
+        image = synthetic_image(width, height)
+        output_size = cv.output_size(width, height)
+        output = cv2.resize(image, output_size)
+        area = ((0, int(output_size[1] * 0.65)), (int(output_size[0] * 0.55), output_size[1]))
+        add('draw_image', name, lambda: cv.draw_image(output, logo[:60, :120], ((10, 10), (130, 70)), area))
+        for kind in LAYOUTS:
+            objects = synthetic_layout(kind)
+
+            def cold():
+                cv.layer_cache.clear()
+                cv.draw_watermarks(image, objects, CANVAS_SIZE)
+
+            add('draw_watermarks_cold', name, cold, layout=kind)
+            add('draw_watermarks', name, lambda: cv.draw_watermarks(image, objects, CANVAS_SIZE), layout=kind)
+            layout = WatermarkLayout.from_objects(objects, CANVAS_SIZE)
+            add('draw_batch', name, lambda: cv.draw_batch([image] * BATCH_IMAGES, layout, stack=stack), layout=kind,
+                images=BATCH_IMAGES)
+    return results
+
+
+def benchmark_export(sizes, count, formats, window):
+    """ Time the end-to-end export of `count` images per size from disk to encoded files. """
+    results = []
+    objects = synthetic_layout('mixed')
+    for name in sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            image = synthetic_image(*IMAGE_SIZES[name])
+            paths = []
+            for index in range(count):
+                paths.append(f'{folder}/source_{index}.jpg')
+                cv2.imwrite(paths[-1], image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+            names = [f'image_{index}' for index in range(count)]
+            for format in formats:
+                # A fresh manager and output folder per run so nothing is served from a cache or skipped
+                run = lambda: CVManager().export_images(folder, paths, names, objects, CANVAS_SIZE, 1, window,
+                                                        ImageEncoder(format), resume=False)
+                start = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - start
+                tracemalloc.start()
+                run()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                results.append({'stage': 'export', 'size': name, 'format': format, 'images': count,
+                                'seconds': round(elapsed, 4), 'images_per_sec': round(count / elapsed, 2),
+                                'megapixels_per_sec': round(count * image.size / 3 / elapsed / 1e6, 2),
+                                'peak_alloc_mb': round(peak / 2 ** 20, 3)})
+    return results
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20, 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the PyMark watermarking hot paths.')
+    parser.add_argument('--sizes', nargs='+', default=list(IMAGE_SIZES), choices=list(IMAGE_SIZES))
+    parser.add_argument('--repeat', type=int, default=10, help='timed runs per stage')
+    parser.add_argument('--export-images', type=int, default=8, help='images per export run, 0 to skip exports')
+    parser.add_argument('--formats', nargs='+', default=['png', 'jpeg'], choices=['png', 'jpeg', 'webp'])
+    parser.add_argument('--window', type=int, default=4, help='export tasks in flight')
+    parser.add_argument('-o', '--output', help='write the JSON report to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = {
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+                        'platform': platform.platform(), 'cores': os.cpu_count(),
+                        'opencv_threads': cv2.getNumThreads()},
+        'stages': benchmark_stages(args.sizes, args.repeat),
+        'export': benchmark_export(args.sizes, args.export_images, args.formats, args.window)
+        if args.export_images else [],
+    }
+    report['peak_rss_mb'] = peak_rss_mb()
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
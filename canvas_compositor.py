@@ -0,0 +1,43 @@
+def union_rect(first, second):
+    """ Get the smallest (x, y, width, height) rect containing both rects, either of which may be None. """
+    if first is None:
+        return second
+    if second is None:
+        return first
+    x, y = min(first[0], second[0]), min(first[1], second[1])
+    return (x, y, max(first[0] + first[2], second[0] + second[2]) - x,
+            max(first[1] + first[3], second[1] + second[3]) - y)
+
+
+def clip_rect(rect, shape):
+    """ Clip an (x, y, width, height) rect to an image shape, or get None if nothing is left. """
+    x0, y0 = max(0, rect[0]), max(0, rect[1])
+    x1, y1 = min(shape[1], rect[0] + rect[2]), min(shape[0], rect[1] + rect[3])
+    return (x0, y0, x1 - x0, y1 - y0) if x1 > x0 and y1 > y0 else None
+
+
+class CanvasCompositor:
+    """ Keep the live selection layer of the editing canvas apart from its committed base layer.
+
+    `frame` is what the canvas shows: the base with the selection painted over it. Each update puts
+    the base back only under the previous selection rect and paints the new one, so a drag step costs
+    in proportion to the selection size, not the canvas size.
+    """
+
+    def __init__(self, base, rect=None):
+        self.base = base
+        self.frame = base.copy()
+        self.rect = clip_rect(rect, base.shape) if rect else None
+
+    def update(self, paint):
+        """ Replace the selection layer using paint(frame), which returns the rect it painted.
+
+        Returns the dirty rect that has to be pushed to the screen.
+        """
+        previous = self.rect
+        if previous:
+            x, y, width, height = previous
+            self.frame[y:y + height, x:x + width] = self.base[y:y + height, x:x + width]
+        rect = paint(self.frame)
+        self.rect = clip_rect(rect, self.frame.shape) if rect else None
+        return union_rect(previous, self.rect)
@@ -1,42 +1,293 @@
 import os
 import cv2
 import math
+import contextlib
+import itertools
+import struct
 import numpy as np
-from PyQt5.QtCore import Qt, QSize
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import bounded_map
+from image_cache import ImageCache
+from image_encoder import ImageEncoder
+from layout import WatermarkLayout, TextWatermark
+from instrumentation import Instrumentation
+from image_stack import ImageStack
+from text_renderer import TextRenderer
+from canvas_compositor import union_rect, clip_rect
+from watermark_layer import WatermarkLayer, LayerCache
+
+
+# Reduced decode modes, largest reduction first
+REDUCED_READ_MODES = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                      (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+# Fraction of the image height above which no watermark is ever drawn
+WATERMARK_BAND_TOP = 0.5
+# Images with more pixels than this are memory-mapped and tiled unless CVManager is given another limit
+TILE_PIXELS = 100 * 10 ** 6
 
 
 class CVManager:
+    def __init__(self, layer_cache_size=16, image_cache_bytes=512 * 2 ** 20, tile_pixels=None,
+                 tile_size=1024, map_folder=None, sprite_cache_size=256):
+        self.layer_cache = LayerCache(layer_cache_size)
+        self.image_cache = ImageCache(image_cache_bytes)
+        self.text_renderer = TextRenderer(sprite_cache_size)
+        # Replace with an enabled Instrumentation to time the export stages
+        self.instruments = Instrumentation()
+        # Replace with an AutoPlacement to move or recolour each watermark to suit the image it lands on
+        self.auto_placement = None
+        self.encoder = ImageEncoder()
+        # Images above tile_pixels are decoded into a memory-mapped file and watermarked in tiles. The file goes
+        # in map_folder, by default the folder being exported into, as the temporary folder is often in memory
+        self.tile_pixels = TILE_PIXELS if tile_pixels is None else tile_pixels
+        self.tile_size = tile_size
+        self.map_folder = map_folder
+
     def load_image(self, image_path):
         """ Load an image from the given path. """
-        return cv2.imread(image_path)
+        with self.instruments.stage('decode'):
+            return cv2.imread(image_path)
 
-    def save_images(self, folder, images):
-        """ Save images to the specified folder. """
+    def load_proxy(self, image_path, size=(600, 300)):
+        """ Load a preview-sized copy of an image, decoding JPEGs at reduced resolution when possible. """
+        read_mode = cv2.IMREAD_COLOR
+        image_size = self.image_size(image_path)
+        if image_size:
+            # Compare sorted sides so EXIF rotation applied by imread cannot make the proxy too small
+            short_side, long_side = sorted(image_size)
+            for factor, reduced_mode in REDUCED_READ_MODES:
+                if short_side // factor >= min(size) and long_side // factor >= max(size):
+                    read_mode = reduced_mode
+                    break
+        image = cv2.imread(image_path, read_mode)
+        return None if image is None else cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    def image_size(self, image_path):
+        """ Read the (width, height) of a PNG, JPEG or TIFF from its header, or None if it cannot be read. """
+        try:
+            with open(image_path, 'rb') as image_file:
+                header = image_file.read(24)
+                if header.startswith(b'\x89PNG') and header[12:16] == b'IHDR':
+                    return struct.unpack('>II', header[16:24])
+                if header[:4] in (b'II*\x00', b'MM\x00*'):
+                    return self.tiff_size(image_file, '<' if header[:2] == b'II' else '>')
+                if not header.startswith(b'\xff\xd8'):
+                    return None
+                # Walk the JPEG markers until a start-of-frame segment
+                image_file.seek(2)
+                while True:
+                    marker = image_file.read(2)
+                    if len(marker) < 2 or marker[0] != 0xFF:
+                        return None
+                    length = struct.unpack('>H', image_file.read(2))[0]
+                    if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                        height, width = struct.unpack('>xHH', image_file.read(5))
+                        return width, height
+                    image_file.seek(length - 2, os.SEEK_CUR)
+        except (OSError, struct.error):
+            return None
+
+    def tiff_size(self, image_file, byte_order):
+        """ Read the (width, height) tags of the first TIFF image directory. """
+        image_file.seek(4)
+        image_file.seek(struct.unpack(byte_order + 'I', image_file.read(4))[0])
+        size = {}
+        for _ in range(struct.unpack(byte_order + 'H', image_file.read(2))[0]):
+            tag, value_type, _, value = struct.unpack(byte_order + 'HHI4s', image_file.read(12))
+            if tag in (256, 257):
+                # Short values sit in the first two bytes of the value field
+                size[tag] = struct.unpack(byte_order + ('H2x' if value_type == 3 else 'I'), value)[0]
+        return (size[256], size[257]) if len(size) == 2 else None
+
+    def is_large(self, image_size):
+        """ Check if an image of the given (width, height) goes through the tiled path. """
+        return image_size is not None and image_size[0] * image_size[1] > self.tile_pixels
+
+    def create_folder(self, folder, reuse=False):
+        """ Create a new PyMark output folder inside the given folder, or with `reuse` keep using PyMark. """
         # Generate folder names with sequential numbering if the folder already exists
-        for n in range(100):
+        for n in itertools.count():
             path = f'{folder}/PyMark' if n == 0 else f'{folder}/PyMark_{n}'
-            if not os.path.exists(path):
+            if reuse and os.path.isdir(path):
+                return path
+            try:
                 os.makedirs(path)
-                break
-        # Save each image with its corresponding name
-        for image_data, image_name in images:
-            cv2.imwrite(f'{path}/{image_name}.png', image_data)
+                return path
+            except FileExistsError:
+                continue
+
+    def save_image(self, path, image_name, image_data, encoder=None):
+        """ Save a single image to the specified folder. """
+        with self.instruments.stage('encode'):
+            return (encoder or self.encoder).save(path, image_name, image_data)
+
+    def save_images(self, folder, images, encoder=None):
+        """ Save images to the specified folder. """
+        path = self.create_folder(folder)
+        # Encode and write each image with its corresponding name on the encoder's thread pool
+        (encoder or self.encoder).save_all(path, images)
+        return path
+
+    def export_images(self, folder, image_paths, image_names, watermark_objects, canvas_size, scalar=1, window=4,
+                      encoder=None, native=False, resume=True):
+        """ Stream images from disk through watermarking into a PyMark output folder.
+
+        Each image is decoded, watermarked and written by one task, and at most `window` tasks run at
+        once, so memory stays flat no matter how many paths are exported. With `resume` the PyMark
+        folder of an earlier export is reused and its manifest decides what is left to do: outputs
+        that are up to date are skipped and identical sources are written once and copied. Returns
+        the names written by this run.
+        """
+        # Only exports need the manifest, keep it out of the import of the imaging core
+        from export_manifest import ExportManifest
+        path = self.create_folder(folder, reuse=resume)
+        layout = WatermarkLayout.from_objects(watermark_objects, canvas_size, scalar)
+        encoder = encoder or self.encoder
+        manifest = ExportManifest(path)
+        with self.instruments.stage('plan'):
+            render, copies, _ = manifest.plan(zip(image_paths, image_names), layout.content_hash,
+                                              {**encoder.settings, **self.placement_settings, 'native': native},
+                                              encoder.extension)
+
+        def export(item):
+            image_path, image_name, key = item
+            with self.instruments.profiled():
+                image_name = self.export_image(path, image_path, image_name, layout, encoder, native, cache=True)
+            if image_name:
+                manifest.record(image_name, encoder.extension, key)
+            return image_name
+
+        try:
+            with self.instruments.traced(), ThreadPoolExecutor(window) as executor:
+                names = [name for name in bounded_map(executor, export, render, window) if name]
+            names += [name for name in (manifest.copy(*copy[:2], encoder.extension, copy[2]) for copy in copies)
+                      if name]
+        finally:
+            manifest.save()
+        return names
 
-       def fitImage(self, image, canvas_size, background_image=None, gap=(0,0)):
-        """ Resize and position the given image to fit within the canvas size."""
+    def export_image(self, path, image_path, image_name, layout, encoder=None, native=False, cache=False):
+        """ Load, watermark and save a single image, returning its name or None if it cannot be read or written.
+
+        Images above `tile_pixels` are decoded into a memory-mapped buffer (see open_image). In native
+        mode they are watermarked tile by tile, in place, and the mapped buffer is handed to the encoder
+        as is.
+        """
+        with self.open_image(image_path, path, cache) as image:
+            if image is None:
+                return None
+            try:
+                if native and self.is_large(image.shape[1::-1]):
+                    image = self.draw_tiled(image, layout)
+                else:
+                    # Native rendering draws in place, keep the cached decode clean
+                    image = self.draw_layout(image.copy() if native and cache else image, layout, native)
+                self.save_image(path, image_name, image, encoder)
+            except OSError:
+                return None
+            finally:
+                # A mapped buffer is removed at the end of the block, which needs every view of it gone
+                image = None
+        return image_name
+
+    @contextlib.contextmanager
+    def open_image(self, image_path, folder=None, cache=False):
+        """ Decode an image for the duration of a with block, getting None if it cannot be read.
+
+        Images above `tile_pixels` are decoded into a memory-mapped file in `map_folder`, or else in
+        `folder`, instead of memory, never go through the image cache, and are removed when the block
+        ends. Other images come from the image cache with `cache`.
+        """
+        image_size = self.image_size(image_path)
+        if not self.is_large(image_size):
+            yield self.image_cache.get(image_path, self.load_image) if cache else self.load_image(image_path)
+            return
+        from mapped_image import MappedImage
+        with self.instruments.stage('decode'):
+            mapped = MappedImage.read(image_path, image_size, self.map_folder or folder)
+        if mapped is None:
+            yield None
+            return
+        with mapped:
+            yield mapped.array
+
+    def export_renditions(self, path, image_paths, image_names, layout, renditions, window=4):
+        """ Export every rendition of each image into a subfolder of the output folder `path`.
+
+        Each image is decoded once and all of its renditions are derived from it (see draw_renditions)
+        and encoded in parallel, while up to `window` images are processed at once. Images above
+        `tile_pixels` are decoded into a memory-mapped buffer (see open_image). One manifest in
+        `path` tracks all renditions, so only outputs that are missing or out of date are redone.
+        Returns the rendition outputs written by this run, as 'rendition/name', and the number of
+        outputs that could not be read or written.
+        """
+        from export_manifest import ExportManifest
+        manifest = ExportManifest(path)
+        # Image path -> (image name, {rendition index: manifest key}) of the outputs left to render
+        work = {}
+        copies = []
+        with self.instruments.stage('plan'):
+            for index, rendition in enumerate(renditions):
+                os.makedirs(os.path.join(path, rendition.name), exist_ok=True)
+                items = ((image_path, f'{rendition.name}/{image_name}')
+                         for image_path, image_name in zip(image_paths, image_names))
+                render, rendition_copies, _ = manifest.plan(items, layout.content_hash,
+                                                            {**rendition.settings, **self.placement_settings},
+                                                            rendition.encoder.extension)
+                for image_path, output_name, key in render:
+                    work.setdefault(image_path, (output_name.split('/', 1)[1], {}))[1][index] = key
+                copies += [(copy, rendition.encoder.extension) for copy in rendition_copies]
+
+        def write(output_name, image, rendition, key):
+            try:
+                self.save_image(path, output_name, image, rendition.encoder)
+            except OSError:
+                return None
+            # Only outputs that are on disk go into the manifest, anything else is redone next time
+            manifest.record(output_name, rendition.encoder.extension, key)
+            return output_name
+
+        def export(item):
+            image_path, (image_name, keys) = item
+            with self.open_image(image_path, path) as image:
+                if image is None:
+                    return [None] * len(keys)
+                try:
+                    chosen = [renditions[index] for index in keys]
+                    images = self.draw_renditions(image, layout, chosen)
+                    # OpenCV releases the GIL while encoding, so the renditions are written side by side
+                    output_names = [f'{rendition.name}/{image_name}' for rendition in chosen]
+                    return list(writer.map(write, output_names, images, chosen, keys.values()))
+                finally:
+                    # Full-size renditions are views of a mapped buffer, which has to be unused to be removed
+                    image = images = None
+
+        try:
+            with self.instruments.traced(), ThreadPoolExecutor(window) as executor, \
+                    ThreadPoolExecutor(window * len(renditions)) as writer:
+                names = [name for names in bounded_map(executor, export, work.items(), window) for name in names]
+            names += [manifest.copy(*copy[:2], extension, copy[2]) for copy, extension in copies]
+        finally:
+            manifest.save()
+        return [name for name in names if name], names.count(None)
+
+    def fitImage(self, image, canvas_size, background_image=None, gap=(0,0)):
+        """ Resize and position the given image to fit within the (width, height) canvas size."""
+        canvas_width, canvas_height = canvas_size
         if background_image is None:
-            background_image = np.full((canvas_size.height(), canvas_size.width(), 3), (255, 255, 255), dtype=np.uint8)
+            background_image = np.full((canvas_height, canvas_width, 3), (255, 255, 255), dtype=np.uint8)
         image_y, image_x = image.shape[:2]
         # Adjust image dimensions to fit within the canvas size
-        image_x = canvas_size.width() if  image_x > canvas_size.width() else image_x
-        image_y = canvas_size.height() if image_y > canvas_size.height() else image_y
+        image_x = canvas_width if  image_x > canvas_width else image_x
+        image_y = canvas_height if image_y > canvas_height else image_y
         image_x = image_x - gap[0] if image_x - gap[0] > 0 else image_x
         image_y = image_y - gap[1] if image_y -gap[1] > 0 else image_y
 
         image = cv2.resize(image, (image_x, image_y))
         # Position the image in the center of the canvas
-        y = (canvas_size.height() - image.shape[0]) // 2
-        x = (canvas_size.width() - image.shape[1]) // 2
+        y = (canvas_height - image.shape[0]) // 2
+        x = (canvas_width - image.shape[1]) // 2
         background_image[y:y + image.shape[0], x:x + image.shape[1]] = image
         return background_image, image
 
@@ -64,19 +315,60 @@ class CVManager:
             cv2.line(image, (top_left[0], top_left[1] + (dst * i * y_dir)),
                      (top_left[0], top_left[1] + (dst // 3 + (dst * i)) * y_dir), (0, 0, 0), 1, cv2.LINE_AA)
 
+    def draw_canvas(self, image, watermark_objects, bounds):
+        """ Draw watermark objects onto the editor canvas the way the editor places them. """
+        for watermark, watermark_pos in watermark_objects:
+            if isinstance(watermark, TextWatermark):
+                self.text_renderer.draw(image, watermark.text, (watermark_pos[0][0], watermark_pos[1][1]),
+                                        watermark.font, 0.5 * watermark.size, watermark.color,
+                                        2 if watermark.bold else 1)
+            else:
+                image = self.move_selection(image, watermark.image, watermark_pos, bounds)[0]
+        return image
+
+    def canvas_rect(self, watermark, watermark_pos):
+        """ Get the (x, y, width, height) a watermark object covers on the editor canvas. """
+        if isinstance(watermark, TextWatermark):
+            return self.text_renderer.text_rect(watermark.text, (watermark_pos[0][0], watermark_pos[1][1]),
+                                                watermark.font, 0.5 * watermark.size, watermark.color,
+                                                2 if watermark.bold else 1)
+        return (*watermark_pos[0], watermark.image.shape[1], watermark.image.shape[0])
+
+    def redraw_canvas(self, image, watermark_objects, rect):
+        """ Redraw a rect of the editor canvas from a blank background with the objects that overlap it. """
+        x, y, width, height = rect
+        region = image[y:y + height, x:x + width]
+        region[:] = 255
+        for watermark, watermark_pos in watermark_objects:
+            object_x, object_y, object_width, object_height = self.canvas_rect(watermark, watermark_pos)
+            if (object_x >= x + width or object_x + object_width <= x or
+                    object_y >= y + height or object_y + object_height <= y):
+                continue
+            if isinstance(watermark, TextWatermark):
+                self.text_renderer.draw(region, watermark.text, (watermark_pos[0][0] - x, watermark_pos[1][1] - y),
+                                        watermark.font, 0.5 * watermark.size, watermark.color,
+                                        2 if watermark.bold else 1)
+            else:
+                x0, y0 = max(x, object_x), max(y, object_y)
+                x1, y1 = min(x + width, object_x + object_width), min(y + height, object_y + object_height)
+                region[y0 - y:y1 - y, x0 - x:x1 - x] = watermark.image[y0 - object_y:y1 - object_y,
+                                                                       x0 - object_x:x1 - object_x]
+        return image
+
     def move_selection(self, image, selection, selection_pos, bounds):
-        """ Move the selected area within the image bounds."""
+        """ Move the selected area within the (width, height) image bounds."""
+        width, height = bounds
         # Adjust selection position to fit within the image bounds
         if selection_pos[0][0] <= 4:
             selection_pos = ((4, selection_pos[0][1]), (4 + selection.shape[1], selection_pos[1][1]))
-        if selection_pos[1][0] >= bounds.width() - 4:
+        if selection_pos[1][0] >= width - 4:
             selection_pos = (
-            (bounds.width() - 4 - selection.shape[1], selection_pos[0][1]), (bounds.width() - 4, selection_pos[1][1]))
+            (width - 4 - selection.shape[1], selection_pos[0][1]), (width - 4, selection_pos[1][1]))
         if selection_pos[0][1] <= 3:
             selection_pos = ((selection_pos[0][0], 3), (selection_pos[1][0], 3 + selection.shape[0]))
-        if selection_pos[1][1] >= bounds.height() - 4:
+        if selection_pos[1][1] >= height - 4:
             selection_pos = (
-            (selection_pos[0][0], bounds.height() - 4 - selection.shape[0]), (selection_pos[1][0], bounds.height() - 4))
+            (selection_pos[0][0], height - 4 - selection.shape[0]), (selection_pos[1][0], height - 4))
         # Move the selection to the new position
         start_pos, end_pos = selection_pos
         end_pos = end_pos if end_pos[1]-start_pos[1] == selection.shape[0] else (end_pos[0],end_pos[1]+1)
@@ -84,47 +376,354 @@ class CVManager:
         image[start_pos[1]:end_pos[1],start_pos[0]:end_pos[0]] = selection
         return image, selection_pos
 
-    def draw_image(self, image, watermark, watermark_pos, watermark_area, scalar=1):
+    def draw_image(self, image, watermark, watermark_pos, watermark_area, scalar=1, pixel_scale=1):
+        x, y, x_gap, y_gap = self.image_rect(image.shape[1::-1], watermark_pos, watermark_area, scalar, pixel_scale)
+        if x_gap > x and y_gap > y:
+            image[y:y_gap, x:x_gap] = cv2.resize(watermark, (x_gap - x, y_gap - y))
+        return image
+
+    def image_rect(self, image_size, watermark_pos, watermark_area, scalar=1, pixel_scale=1):
+        """ Get the (x, y, x_gap, y_gap) an image watermark covers, cut off at the image edges. """
         origin_scalar = scalar
         scalar = 1 + (scalar - 1) * 0.2
         width = int((watermark_pos[1][0] - watermark_pos[0][0]) // scalar)
         heigth = int((watermark_pos[1][1] - watermark_pos[0][1]) // scalar)
         x = int(watermark_area[0][0] + watermark_pos[0][0] // scalar)
-        y = int(watermark_area[0][1] + watermark_pos[0][1] // scalar + (12 * (origin_scalar - 1)))
-        x_gap = x + width
-        y_gap = y + heigth
-        watermark = cv2.resize(watermark, (image[y:y_gap, x:x_gap].shape[:2:][::-1]))
-        image[y:y_gap, x:x_gap] = watermark
-        return image
+        y = int(watermark_area[0][1] + watermark_pos[0][1] // scalar + int(12 * (origin_scalar - 1) * pixel_scale))
+        return x, y, min(x + width, image_size[0]), min(y + heigth, image_size[1])
+
+    def output_size(self, width, height):
+        """ Get the size an image of the given size is resized to before watermarking. """
+        return min(max(600, width), 1920), min(max(300, height), 1080)
 
     def draw_watermarks(self, image, watermark_objects, watermark_canvas_size, scalar=1):
+        return self.draw_layout(image, WatermarkLayout.from_objects(watermark_objects, watermark_canvas_size, scalar))
+
+    def draw_layout(self, image, layout, native=False):
+        """ Apply the watermark layout to an image.
+
+        By default the image is first resized into the output size limits. With `native` the source
+        resolution is kept, the layout is mapped into source pixels and only the watermarked region of
+        the image is written, in place.
+        """
         height, width = image.shape[:2]
-        # Resize the image to ensure it fits within specified limits
-        image = cv2.resize(image, (min(max(600, width), 1920), min(max(300, height), 1080)))
-        if watermark_objects:
-            height, width = image.shape[:2]
-            for watermark, watermark_pos in watermark_objects:
-                # Position and draw text watermark
-                if type(watermark) == tuple:
-                    watermark_area = ((0, int(height * (0.60 + 0.04 * watermark[1][2]))), (int(width * 0.55), height))
-                    x_ratio = (watermark_area[1][0] - watermark_area[0][0]) / watermark_canvas_size.width()
-                    y_ratio = (watermark_area[1][1] - watermark_area[0][1]) / watermark_canvas_size.height()
-                    watermark_pos = (watermark_area[0][0] + int(watermark_pos[0][0] * x_ratio),
-                                     watermark_area[0][1] + int(watermark_pos[0][1] * y_ratio) + 10)
-                    cv2.putText(image, watermark[1][3], watermark_pos, watermark[1][1],
-                                0.4 * watermark[1][2] - 0.1 * (scalar-1),
-                                watermark[1][0], 2 if watermark[1][4] else 1)
-                # Position and draw image watermark
-                else:
-                    watermark_area = ((0, int(height * 0.65)), (int(width * 0.55), height))
-                    print(scalar)
-                    x_ratio = (watermark_area[1][0] - watermark_area[0][0]) / watermark_canvas_size.width()
-                    y_ratio = (watermark_area[1][1] - watermark_area[0][1]) / watermark_canvas_size.height()
-                    watermark_pos = ((int(watermark_pos[0][0] * x_ratio), int(watermark_pos[0][1] * y_ratio)+(10 if scalar != 1 else 0)),
-                                     (int(watermark_pos[1][0] * x_ratio), int(watermark_pos[1][1] * y_ratio)+(10 if scalar != 1 else 0)))
-                    image = self.draw_image(image, watermark, watermark_pos, watermark_area, scalar)
+        output_size = self.output_size(width, height)
+        if native:
+            pixel_scale = self.native_scale(width, height)
+            output_size = (width, height)
+        else:
+            pixel_scale = 1
+            # Resize the image to ensure it fits within specified limits
+            with self.instruments.stage('resize'):
+                image = cv2.resize(image, output_size)
+        if layout.objects:
+            self.apply_layout(image, layout, pixel_scale)
+        return image
+
+    def apply_layout(self, image, layout, pixel_scale=1):
+        """ Composite the layout onto an image that is already at its output size, in place.
+
+        With auto placement on, the cached layer is moved to where the image suits it best, or
+        swapped for one with recoloured text.
+        """
+        output_size = (image.shape[1], image.shape[0])
+        layer = self.compile_layer(layout, output_size, pixel_scale)
+        origin = (0, 0)
+        if self.auto_placement and layer.overlay is not None:
+            with self.instruments.stage('place'):
+                origin, tone = self.auto_placement.place(image, layer)
+                recolored = self.auto_placement.recolor(layout, tone) if tone else None
+            if recolored:
+                layer = self.compile_layer(recolored, output_size, pixel_scale)
+        with self.instruments.stage('composite'):
+            layer.apply(image, origin)
         return image
 
+    @property
+    def placement_settings(self):
+        """ Get the export settings auto placement adds, so outputs made with and without it differ. """
+        return {'auto_place': True} if self.auto_placement else {}
+
+    def draw_batch(self, images, layout, native=False, stack=None):
+        """ Apply the watermark layout to many images, blending each group of same-size images as one stack.
+
+        Images are grouped by shape and each group is resized into an (N, H, W, 3) stack, so a group
+        costs one layer lookup and one pass over the watermarked region of the stack however many
+        images it holds, and nothing is allocated per image. Returns the watermarked images in input
+        order, as views into `stack` (an ImageStack) that stay valid until it is reused. With
+        `native` nothing is resized and the images are watermarked in place, like draw_layout does.
+        """
+        stack = stack or ImageStack()
+        stack.reset()
+        groups = {}
+        for index, image in enumerate(images):
+            groups.setdefault(image.shape, []).append(index)
+        results = [None] * len(images)
+        for (height, width, _), indices in groups.items():
+            if native:
+                output_size, pixel_scale = (width, height), self.native_scale(width, height)
+                # Stacking would copy every image, so each one is a stack of its own
+                group = [images[index][np.newaxis] for index in indices]
+            else:
+                output_size, pixel_scale = self.output_size(width, height), 1
+                group = [stack.take(len(indices), output_size[1], output_size[0])]
+                with self.instruments.stage('resize'):
+                    for slot, index in zip(group[0], indices):
+                        cv2.resize(images[index], output_size, dst=slot)
+            if layout.objects and self.auto_placement:
+                # Every image gets a placement of its own, so they cannot share one blend
+                for image in (image for images_stack in group for image in images_stack):
+                    self.apply_layout(image, layout, pixel_scale)
+            elif layout.objects:
+                layer = self.compile_layer(layout, output_size, pixel_scale)
+                _, _, layer_width, layer_height = layer.rect
+                scratch = stack.scratch(layer_height * layer_width * 3)
+                with self.instruments.stage('composite'):
+                    for images_stack in group:
+                        layer.apply_stack(images_stack, scratch=scratch)
+            for slot, index in zip((image for images_stack in group for image in images_stack), indices):
+                results[index] = slot
+        return results
+
+    def draw_renditions(self, image, layout, renditions):
+        """ Watermark an image for every rendition, returning one image per rendition.
+
+        Rendition sizes form a resize pyramid: all sizes are made from the clean image, largest first,
+        each one from the smallest size already made that covers it, stepping down by halves where it
+        can, before any watermark is drawn.
+        The watermark layer of each rendition size is compiled once and cached. A rendition that keeps
+        the source size is watermarked on `image` itself, in place.
+        """
+        height, width = image.shape[:2]
+        keys = []
+        for rendition in renditions:
+            size = rendition.output_size(width, height)
+            keys.append((size, round(self.native_scale(*size) * rendition.watermark_scale, 4)))
+        levels = {(width, height): image}
+        with self.instruments.stage('resize'):
+            for size in sorted({size for size, _ in keys} - set(levels), key=lambda size: size[0] * size[1],
+                               reverse=True):
+                source = min((level for (level_width, level_height), level in levels.items()
+                              if level_width >= size[0] and level_height >= size[1]), key=lambda level: level.size)
+                # An area resize by exactly two is several times cheaper than by a fraction, so halve first
+                while source.shape[1] // 2 >= size[0] and source.shape[0] // 2 >= size[1]:
+                    half = (source.shape[1] // 2, source.shape[0] // 2)
+                    if half not in levels:
+                        levels[half] = cv2.resize(source, half, interpolation=cv2.INTER_AREA)
+                    source = levels[half]
+                if size not in levels:
+                    levels[size] = cv2.resize(source, size, interpolation=cv2.INTER_AREA)
+        # Renditions of one size and watermark scale share an output, other scales of that size need a copy
+        outputs = {}
+        for size, pixel_scale in keys:
+            if (size, pixel_scale) not in outputs:
+                shared = any(output_size == size for output_size, _ in outputs)
+                outputs[size, pixel_scale] = levels[size].copy() if shared else levels[size]
+        if layout.objects:
+            for (size, pixel_scale), output in outputs.items():
+                self.apply_layout(output, layout, pixel_scale)
+        return [outputs[key] for key in keys]
+
+    def native_scale(self, width, height):
+        """ Get the factor that maps output pixels to the pixels of a source kept at its own size. """
+        # Offsets and text sizes are defined in output pixels, scale them to the source
+        output_size = self.output_size(width, height)
+        return min(width / output_size[0], height / output_size[1])
+
+    def draw_tiled(self, image, layout):
+        """ Apply the watermark layout to an image at its own resolution, one tile at a time, in place.
+
+        Only the tiles that intersect the layout are rendered and blended, and each one needs just
+        tile-sized buffers, so memory does not grow with the image size.
+        """
+        if not layout.objects:
+            return image
+        height, width = image.shape[:2]
+        placements = self.watermark_placements(layout, (width, height), self.native_scale(width, height))
+        rect = clip_rect(self.placements_rect(placements), image.shape)
+        if rect is None:
+            return image
+        # Drawn again for every tile, putText would clip its strokes at each tile edge and could leave
+        # stray pixels along the seams, so text is rendered once and pasted into the tiles like an image
+        blacks, whites = self.text_clusters(placements, (0, int(height * WATERMARK_BAND_TOP), width, height))
+        images = [placement for placement in placements if placement[0] != 'text']
+        for placement in blacks:
+            rect = union_rect(rect, clip_rect(self.placements_rect([placement]), image.shape))
+        x, y, rect_width, rect_height = rect
+        for tile_y in range(y, y + rect_height, self.tile_size):
+            for tile_x in range(x, x + rect_width, self.tile_size):
+                tile_width = min(self.tile_size, x + rect_width - tile_x)
+                tile_height = min(self.tile_size, y + rect_height - tile_y)
+                with self.instruments.stage('render'):
+                    black = np.zeros((tile_height, tile_width, 3), dtype=np.uint8)
+                    white = np.full_like(black, 255)
+                    self.paint_placements(black, images + blacks, (tile_x, tile_y))
+                    self.paint_placements(white, images + whites, (tile_x, tile_y))
+                    layer = WatermarkLayer.from_renders(black, white, (tile_x, tile_y))
+                with self.instruments.stage('composite'):
+                    layer.apply(image)
+        return image
+
+    def compile_layer(self, layout, output_size, pixel_scale=1):
+        """ Get the watermark layer for an output size, rendering it only if it is not cached yet. """
+        def render():
+            with self.instruments.stage('render'):
+                # Watermarks land in the lower part of the image, the band above it is never rendered
+                top = int(output_size[1] * WATERMARK_BAND_TOP)
+                placements = self.watermark_placements(layout, output_size, pixel_scale)
+                # Only the region the watermarks can paint is rendered, so a new size costs what the layout
+                # covers rather than what the image does
+                bounds = self.paint_bounds(placements, (0, top, *output_size))
+                if bounds is None:
+                    return WatermarkLayer(None, (0, 0))
+                x0, y0, x1, y1 = bounds
+                black = np.zeros((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+                white = np.full_like(black, 255)
+                self.paint_placements(black, placements, (x0, y0))
+                self.paint_placements(white, placements, (x0, y0))
+                return WatermarkLayer.from_renders(black, white, (x0, y0))
+
+        # Export threads that start on the same size wait for one render instead of each doing it
+        key = (layout.content_hash, tuple(output_size), layout.scalar, round(pixel_scale, 4))
+        return self.layer_cache.get_or_compile(key, render)
+
+    def watermark_placements(self, layout, output_size, pixel_scale=1):
+        """ Work out where each watermark of a layout lands on an image of the output size.
+
+        Text becomes ('text', text, origin, font, font scale, color, thickness) and images become
+        ('image', resized watermark, (x, y, x_gap, y_gap)), in drawing order. `pixel_scale` scales the
+        fixed pixel offsets and text sizes for outputs above the size limits.
+        """
+        width, height = output_size
+        canvas_width, canvas_height = layout.canvas_size
+        scalar = layout.scalar
+        placements = []
+        for watermark in layout.objects:
+            # Positions are laid out in pixels of the canvas the layout was made on
+            watermark_pos = layout.pixel_position(watermark)
+            # Position text watermark
+            if isinstance(watermark, TextWatermark):
+                watermark_area = ((0, int(height * (0.60 + 0.04 * watermark.size))), (int(width * 0.55), height))
+                x_ratio = (watermark_area[1][0] - watermark_area[0][0]) / canvas_width
+                y_ratio = (watermark_area[1][1] - watermark_area[0][1]) / canvas_height
+                watermark_pos = (watermark_area[0][0] + int(watermark_pos[0][0] * x_ratio),
+                                 watermark_area[0][1] + int(watermark_pos[0][1] * y_ratio) + int(10 * pixel_scale))
+                placements.append(('text', watermark.text, watermark_pos, watermark.font,
+                                   (0.4 * watermark.size - 0.1 * (scalar-1)) * pixel_scale,
+                                   watermark.color, max(1, round((2 if watermark.bold else 1) * pixel_scale))))
+            # Position image watermark
+            else:
+                watermark_area = ((0, int(height * 0.65)), (int(width * 0.55), height))
+                x_ratio = (watermark_area[1][0] - watermark_area[0][0]) / canvas_width
+                y_ratio = (watermark_area[1][1] - watermark_area[0][1]) / canvas_height
+                offset = int(10 * pixel_scale) if scalar != 1 else 0
+                watermark_pos = ((int(watermark_pos[0][0] * x_ratio), int(watermark_pos[0][1] * y_ratio) + offset),
+                                 (int(watermark_pos[1][0] * x_ratio), int(watermark_pos[1][1] * y_ratio) + offset))
+                rect = self.image_rect(output_size, watermark_pos, watermark_area, scalar, pixel_scale)
+                if rect[2] > rect[0] and rect[3] > rect[1]:
+                    placements.append(('image', cv2.resize(watermark.image, (rect[2] - rect[0], rect[3] - rect[1])),
+                                       rect))
+        return placements
+
+    def text_clusters(self, placements, bounds):
+        """ Render every group of overlapping texts once, over black and over white, as image placements.
+
+        Texts whose boxes overlap are rendered together, with whatever else is drawn in their box, in
+        drawing order, so pasting a group's render reproduces that part of the layout exactly. Only
+        (x0, y0, x1, y1) `bounds` are drawn, like the band draw_layout renders. Returns the black and
+        the white renders.
+        """
+        clusters = []
+        for placement in placements:
+            if placement[0] != 'text':
+                continue
+            box = self.text_bounds(placement, bounds)
+            if box is None:
+                continue
+            # Merge with every group the box overlaps, until a grown box overlaps no other group
+            overlapping = True
+            while overlapping:
+                overlapping = [cluster for cluster in clusters if cluster[0] < box[2] and box[0] < cluster[2] and
+                               cluster[1] < box[3] and box[1] < cluster[3]]
+                for cluster in overlapping:
+                    clusters.remove(cluster)
+                    box = [min(box[0], cluster[0]), min(box[1], cluster[1]), max(box[2], cluster[2]),
+                           max(box[3], cluster[3])]
+            clusters.append(box)
+        blacks, whites = [], []
+        for x0, y0, x1, y1 in clusters:
+            black = np.zeros((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+            white = np.full_like(black, 255)
+            self.paint_placements(black, placements, (x0, y0))
+            self.paint_placements(white, placements, (x0, y0))
+            # Keep only the part that was drawn on
+            drawn = (black != 0).any(axis=2) | (white != 255).any(axis=2)
+            rows, cols = np.flatnonzero(drawn.any(axis=1)), np.flatnonzero(drawn.any(axis=0))
+            if not len(rows):
+                continue
+            crop = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+            rect = (x0 + int(cols[0]), y0 + int(rows[0]), x0 + int(cols[-1]) + 1, y0 + int(rows[-1]) + 1)
+            blacks.append(('image', black[crop], rect))
+            whites.append(('image', white[crop], rect))
+        return blacks, whites
+
+    def text_bounds(self, placement, bounds):
+        """ Get the (x0, y0, x1, y1) part of `bounds` a text placement can paint, or None if it paints none of it. """
+        _, text, (x, y), font, font_scale, _, thickness = placement
+        box_x, box_y, box_width, box_height = self.text_renderer.measure(text, font, font_scale, thickness)
+        # The measured box is an estimate, pad it so that no stroke is ever clipped by a render
+        box = [max(x + box_x - box_height, bounds[0]), max(y + box_y - box_height, bounds[1]),
+               min(x + box_x + box_width + box_height, bounds[2]), min(y + box_y + 2 * box_height, bounds[3])]
+        return box if box[2] > box[0] and box[3] > box[1] else None
+
+    def paint_bounds(self, placements, bounds):
+        """ Get the (x0, y0, x1, y1) part of `bounds` that any of the placements can paint, or None. """
+        rect = None
+        for placement in placements:
+            if placement[0] == 'text':
+                box = self.text_bounds(placement, bounds)
+            else:
+                x, y, x_gap, y_gap = placement[2]
+                box = [max(x, bounds[0]), max(y, bounds[1]), min(x_gap, bounds[2]), min(y_gap, bounds[3])]
+                box = box if box[2] > box[0] and box[3] > box[1] else None
+            if box:
+                rect = box if rect is None else [min(rect[0], box[0]), min(rect[1], box[1]),
+                                                 max(rect[2], box[2]), max(rect[3], box[3])]
+        return rect
+
+    def paint_placements(self, image, placements, origin=(0, 0)):
+        """ Draw watermark placements onto a part of the output image whose top left corner is at origin. """
+        left, top = origin
+        for placement in placements:
+            if placement[0] == 'text':
+                _, text, (x, y), font, font_scale, color, thickness = placement
+                # Skip text that cannot reach this part of the image
+                box_x, box_y, box_width, box_height = self.text_renderer.measure(text, font, font_scale, thickness)
+                if (x + box_x < left + image.shape[1] and x + box_x + box_width > left and
+                        y + box_y < top + image.shape[0] and y + box_y + box_height > top):
+                    cv2.putText(image, text, (x - left, y - top), font, font_scale, color, thickness)
+            else:
+                _, watermark, (x, y, x_gap, y_gap) = placement
+                # Paste only the part of the watermark that falls inside the image
+                x0, y0 = max(x, left), max(y, top)
+                x1, y1 = min(x_gap, left + image.shape[1]), min(y_gap, top + image.shape[0])
+                if x1 > x0 and y1 > y0:
+                    image[y0 - top:y1 - top, x0 - left:x1 - left] = watermark[y0 - y:y1 - y, x0 - x:x1 - x]
+        return image
+
+    def placements_rect(self, placements):
+        """ Get an (x, y, width, height) rect that contains every watermark placement. """
+        rect = None
+        for placement in placements:
+            if placement[0] == 'text':
+                _, text, (x, y), font, font_scale, _, thickness = placement
+                box_x, box_y, box_width, box_height = self.text_renderer.measure(text, font, font_scale, thickness)
+                rect = union_rect(rect, (x + box_x, y + box_y, box_width, box_height))
+            else:
+                x, y, x_gap, y_gap = placement[2]
+                rect = union_rect(rect, (x, y, x_gap - x, y_gap - y))
+        return rect
+
     def getGap(self, start_pos, current_pos):
         """ Get the gap between two points. """
         x_gap = start_pos[0] - current_pos[0]
@@ -138,8 +737,8 @@ class CVManager:
         return x_dir, y_dir
 
     def get_rect(self, outter_object, inner_object):
-        """ Get the rectangle coordinates enclosing an inner object within an outer object. """
-        canvas_center = (outter_object.width() // 2, outter_object.height() // 2)
+        """ Get the rectangle coordinates enclosing an inner object centered in a (width, height) outer size. """
+        canvas_center = (outter_object[0] // 2, outter_object[1] // 2)
         selection_y, selection_x = inner_object.shape[:2]
         start_pos = (canvas_center[0] - selection_x // 2, canvas_center[1] - selection_y // 2)
         end_pos = (canvas_center[0] + selection_x // 2, canvas_center[1] + selection_y // 2)
@@ -0,0 +1,108 @@
+from collections import deque
+
+# Rough size of one recorded operation apart from its image payloads
+OPERATION_BYTES = 256
+
+
+class EditOperation:
+    """ One change to a layout entry.
+
+    `kind` is 'add', 'move', 'restyle' or 'delete', and `before` / `after` are the (watermark,
+    position) entry at `index` before and after the change, None where the entry does not exist.
+    """
+    __slots__ = ('kind', 'index', 'before', 'after', 'merge')
+
+    def __init__(self, kind, index, before, after, merge=False):
+        self.kind = kind
+        self.index = index
+        self.before = before
+        self.after = after
+        self.merge = merge
+
+    def payloads(self):
+        """ Get the image watermarks the operation holds on to. """
+        # Image watermarks are told apart by their image, importing layout would load OpenCV with the editor
+        return [entry[0].image for entry in (self.before, self.after)
+                if entry is not None and getattr(entry[0], 'image', None) is not None]
+
+
+class EditHistory:
+    """ Bounded undo/redo history of watermark layout edits.
+
+    Only the changed entry is recorded per operation. Image watermarks are kept by reference and
+    counted once however many operations share them, and the oldest operations are dropped once the
+    history holds more than `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=32 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.undo_stack = deque()
+        self.redo_stack = []
+        # id -> [image, number of operations holding it]
+        self.payloads = {}
+        self.size = 0
+
+    @property
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    @property
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def record(self, kind, index, before, after, merge=False):
+        """ Record a change, merging it into the previous one if both are marked `merge` for the same entry. """
+        for operation in self.redo_stack:
+            self.release(operation)
+        self.redo_stack.clear()
+        last = self.undo_stack[-1] if self.undo_stack else None
+        if merge and last is not None and last.merge and last.kind == kind and last.index == index:
+            self.release(last)
+            last.after = after
+            self.hold(last)
+        else:
+            operation = EditOperation(kind, index, before, after, merge)
+            self.undo_stack.append(operation)
+            self.hold(operation)
+        # Trim from the oldest operation, always keeping the latest one undoable
+        while self.size > self.max_bytes and len(self.undo_stack) > 1:
+            self.release(self.undo_stack.popleft())
+
+    def undo(self):
+        """ Get the operation to revert, or None if there is nothing to undo. """
+        if not self.undo_stack:
+            return None
+        operation = self.undo_stack.pop()
+        self.redo_stack.append(operation)
+        return operation
+
+    def redo(self):
+        """ Get the operation to apply again, or None if there is nothing to redo. """
+        if not self.redo_stack:
+            return None
+        operation = self.redo_stack.pop()
+        self.undo_stack.append(operation)
+        return operation
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.payloads.clear()
+        self.size = 0
+
+    def hold(self, operation):
+        self.size += OPERATION_BYTES
+        for image in operation.payloads():
+            payload = self.payloads.setdefault(id(image), [image, 0])
+            if not payload[1]:
+                self.size += image.nbytes
+            payload[1] += 1
+
+    def release(self, operation):
+        self.size -= OPERATION_BYTES
+        for image in operation.payloads():
+            payload = self.payloads[id(image)]
+            payload[1] -= 1
+            if not payload[1]:
+                self.size -= image.nbytes
+                del self.payloads[id(image)]
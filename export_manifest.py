@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_NAME = 'pymark_manifest.json'
+MANIFEST_VERSION = 1
+
+
+def file_hash(path, chunk_size=2 ** 20):
+    """ Get the content hash of a file, reading it in chunks. """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ExportManifest:
+    """ Record of the files in an export folder and what each one was made from.
+
+    Every output is keyed by the content hash of its source, the layout hash and the encoder
+    settings, so a rerun into the same folder only redoes outputs whose key changed or whose file is
+    missing. Source hashes are cached by path, size and modification time, so unchanged sources are
+    not read again.
+    """
+
+    def __init__(self, folder, save_interval=2):
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST_NAME)
+        self.save_interval = save_interval
+        self.outputs = {}
+        self.sources = {}
+        self.lock = threading.Lock()
+        self.saved_at = time.monotonic()
+        try:
+            with open(self.path) as manifest_file:
+                data = json.load(manifest_file)
+            if data.get('version') == MANIFEST_VERSION:
+                self.outputs = data['outputs']
+                self.sources = data['sources']
+        except (OSError, ValueError, KeyError):
+            # No manifest yet, or one that cannot be trusted: everything is redone
+            pass
+
+    def source_hash(self, path):
+        """ Get the content hash of a source file, or None if it cannot be read. """
+        try:
+            stat = os.stat(path)
+            cached = self.sources.get(path)
+            if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+                return cached[2]
+            content_hash = file_hash(path)
+        except OSError:
+            return None
+        with self.lock:
+            self.sources[path] = [stat.st_size, stat.st_mtime_ns, content_hash]
+        return content_hash
+
+    def plan(self, items, layout_hash, settings, extension, workers=8):
+        """ Split (source path, output name) pairs into the work that is left to do.
+
+        Returns (render, copies, skipped): `render` holds (source path, output name, key) to watermark,
+        `copies` holds (output name, output name to copy from, key) for sources identical to one that
+        is already up to date or rendered first, and `skipped` counts the outputs that are up to date.
+        """
+        items = list(items)
+        with ThreadPoolExecutor(workers) as executor:
+            hashes = list(executor.map(self.source_hash, [path for path, _ in items]))
+        settings = json.dumps(settings, sort_keys=True)
+        keys = [f'{content_hash}:{layout_hash}:{settings}' if content_hash else None for content_hash in hashes]
+        # Outputs that are already up to date can serve as the copy source of identical inputs
+        made = {}
+        current = set()
+        for (_, name), key in zip(items, keys):
+            if key and self.outputs.get(name + extension) == key and os.path.exists(self.output_path(name, extension)):
+                made.setdefault(key, name)
+                current.add(name)
+        render, copies = [], []
+        with self.lock:
+            for (path, name), key in zip(items, keys):
+                if name in current:
+                    continue
+                # The old file is out of date, forget it until the new one is written
+                self.outputs.pop(name + extension, None)
+                if key in made:
+                    copies.append((name, made[key], key))
+                else:
+                    render.append((path, name, key))
+                    if key:
+                        made[key] = name
+        return render, copies, len(current)
+
+    def output_path(self, name, extension):
+        return os.path.join(self.folder, name + extension)
+
+    def copy(self, name, source_name, extension, key):
+        """ Write an output as a copy of an identical one, returning its name or None if that one is missing. """
+        try:
+            shutil.copyfile(self.output_path(source_name, extension), self.output_path(name, extension))
+        except OSError:
+            return None
+        self.record(name, extension, key)
+        return name
+
+    def record(self, name, extension, key):
+        """ Record a written output, saving the manifest every `save_interval` seconds.
+
+        Callers record an output once its write has succeeded, and an output whose file is missing is
+        never recorded, so a resumed export cannot skip it.
+        """
+        if key is None or not os.path.exists(self.output_path(name, extension)):
+            return
+        with self.lock:
+            self.outputs[name + extension] = key
+            if time.monotonic() - self.saved_at >= self.save_interval:
+                self.write()
+
+    def save(self):
+        with self.lock:
+            self.write()
+
+    def write(self):
+        # Write to a temporary file first so an interrupted save never leaves a broken manifest
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as manifest_file:
+            json.dump({'version': MANIFEST_VERSION, 'outputs': self.outputs, 'sources': self.sources},
+                      manifest_file)
+        os.replace(temporary_path, self.path)
+        self.saved_at = time.monotonic()
@@ -0,0 +1,133 @@
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# inotify flags, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+
+PNG_END = b'IEND\xaeB`\x82'
+JPEG_END = b'\xff\xd9'
+
+
+def is_complete(path):
+    """ Check that a PNG or JPEG file ends the way a completely written one does. Other files always pass. """
+    try:
+        with open(path, 'rb') as image_file:
+            header = image_file.read(8)
+            image_file.seek(max(0, os.fstat(image_file.fileno()).st_size - 64))
+            tail = image_file.read()
+    except OSError:
+        return False
+    if header.startswith(b'\x89PNG'):
+        return tail.endswith(PNG_END)
+    if header.startswith(b'\xff\xd8'):
+        # Some cameras pad the file after the end-of-image marker
+        return JPEG_END in tail
+    return bool(header)
+
+
+class InotifyWatcher:
+    """ Report files in a folder as soon as they are closed after writing or moved in, using Linux inotify. """
+
+    def __init__(self, folder):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.folder = folder
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f'Cannot watch {folder}')
+
+    def wait(self, timeout):
+        """ Get the paths of files that are complete, waiting up to `timeout` seconds for the first one. """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        paths = []
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+            path = os.path.join(self.folder, os.fsdecode(name))
+            # A writer may close the file before it is done, the final close is reported again
+            if name and path not in paths and is_complete(path):
+                paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """ Report new or modified files in a folder by scanning it, once they stop changing.
+
+    A file counts as completely written when its size and modification time are the same in two
+    scans in a row and it passes is_complete, so a file is reported between one and two intervals
+    after it was last written.
+    """
+
+    def __init__(self, folder, interval=0.25):
+        self.folder = folder
+        self.interval = interval
+        # Files that are already there are not reported
+        self.seen = self.scan()
+        self.changing = {}
+
+    def scan(self):
+        files = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    continue
+        return files
+
+    def wait(self, timeout):
+        """ Get the paths of files that are complete, waiting up to `timeout` seconds for the first one. """
+        deadline = time.monotonic() + timeout
+        while True:
+            files = self.scan()
+            ready = []
+            for path, state in files.items():
+                if self.seen.get(path) == state:
+                    continue
+                if self.changing.get(path) == state and is_complete(path):
+                    ready.append(path)
+                    self.seen[path] = state
+                else:
+                    self.changing[path] = state
+            # Forget files that were deleted or just reported
+            self.seen = {path: state for path, state in self.seen.items() if path in files}
+            self.changing = {path: state for path, state in self.changing.items()
+                             if path in files and self.seen.get(path) != state}
+            remaining = deadline - time.monotonic()
+            if ready or remaining <= 0:
+                return ready
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+def create_watcher(folder, poll_interval=0.25):
+    """ Watch a folder with inotify where it is available, and by polling it everywhere else. """
+    try:
+        return InotifyWatcher(folder)
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher(folder, poll_interval)
@@ -0,0 +1,186 @@
+import queue
+import multiprocessing
+import cv2
+from cv_manager import CVManager
+from image_encoder import ImageEncoder
+from frame_ring import FrameRing
+from auto_placement import AutoPlacement
+from mapped_image import read_into
+
+# Sent to a stage worker once there is nothing left for it to do
+STOP = None
+# Largest image the render stage produces, see CVManager.output_size
+OUTPUT_BYTES = 1920 * 1080 * 3
+# Share of a batch's images that fit a ring slot, the largest ones are exported on their own instead
+SLOT_PERCENTILE = 0.9
+
+
+def read_frame(frames, slot, path, size):
+    """ Decode an image straight into a ring slot, or get None if it cannot be read or does not fit. """
+    if size and frames.fits((size[1], size[0], 3)):
+        target = frames.view(slot, (size[1], size[0], 3))
+        image = read_into(path, target)
+        if image is target:
+            return target
+    else:
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None or not frames.fits(image.shape):
+        return None
+    # The header size was off (e.g. EXIF rotation), copy the decoded image into the slot
+    frame = frames.view(slot, image.shape)
+    frame[:] = image
+    return frame
+
+
+def decode_stage(sources, decoded, results, frames, layout, folder, encoder_settings, native, tile_pixels,
+                 auto_place=False):
+    """ Decode images into the frame ring and pass their descriptors on to the render stage.
+
+    Images too large for the ring are exported here on their own, memory-mapped and tiled.
+    """
+    cv = CVManager(tile_pixels=tile_pixels)
+    if auto_place:
+        cv.auto_placement = AutoPlacement()
+    encoder = ImageEncoder(**encoder_settings)
+    while True:
+        item = sources.get()
+        if item is STOP:
+            break
+        index, path, name = item
+        slot = frames.acquire()
+        try:
+            size = cv.image_size(path)
+            frame = None if size and cv.is_large(size) else read_frame(frames, slot, path, size)
+            if frame is None:
+                frames.release(slot)
+                slot = None
+                results.put((index, path if cv.export_image(folder, path, name, layout, encoder, native) else None))
+            else:
+                decoded.put((index, path, name, frames.descriptor(slot, frame)))
+        except Exception:
+            if slot is not None:
+                frames.release(slot)
+            results.put((index, None))
+        frame = None
+
+
+def render_stage(decoded, rendered, results, rings, layout, native, auto_place=False):
+    """ Watermark decoded frames, resized into the output ring or in place with `native`. """
+    cv = CVManager()
+    if auto_place:
+        cv.auto_placement = AutoPlacement()
+    frames, outputs = rings
+    while True:
+        item = decoded.get()
+        if item is STOP:
+            break
+        index, path, name, descriptor = item
+        slot = None
+        try:
+            frame = frames.frame(descriptor)
+            if native:
+                cv.draw_layout(frame, layout, native=True)
+                rendered.put((index, path, name, 0, descriptor))
+            else:
+                output_size = cv.output_size(frame.shape[1], frame.shape[0])
+                slot = outputs.acquire()
+                output = outputs.view(slot, (output_size[1], output_size[0], 3))
+                cv2.resize(frame, output_size, dst=output)
+                frames.release(descriptor[0])
+                descriptor = None
+                if layout.objects:
+                    cv.apply_layout(output, layout)
+                rendered.put((index, path, name, 1, outputs.descriptor(slot, output)))
+        except Exception:
+            if descriptor:
+                frames.release(descriptor[0])
+            if slot is not None:
+                outputs.release(slot)
+            results.put((index, None))
+        frame = output = None
+
+
+def encode_stage(rendered, results, rings, folder, encoder_settings):
+    """ Write watermarked frames and hand their slots back to the ring they came from. """
+    encoder = ImageEncoder(**encoder_settings)
+    while True:
+        item = rendered.get()
+        if item is STOP:
+            break
+        index, path, name, ring, descriptor = item
+        try:
+            encoder.save(folder, name, rings[ring].frame(descriptor))
+            results.put((index, path))
+        except Exception:
+            results.put((index, None))
+        finally:
+            rings[ring].release(descriptor[0])
+
+
+def run_pipeline(items, layout, folder, encoder_settings=None, native=False, tile_pixels=None, stages=(1, 1, 1),
+                 auto_place=False, slot_pixels=None):
+    """ Watermark (path, name) items on decode, render and encode processes, yielding each path saved or None.
+
+    `stages` is the number of (decode, render, encode) processes. Frames go from stage to stage
+    through shared memory rings, and only small descriptors are queued, so no image is pickled.
+    Decode slots fit the SLOT_PERCENTILE of the image headers, at most `slot_pixels` pixels, so a
+    few outsized images cannot blow up every slot; images that do not fit are exported by a decode
+    process on their own. Results come in completion order. `auto_place` turns on AutoPlacement in
+    the render stage.
+    """
+    items = list(items)
+    if not items:
+        return
+    decoders, renderers, encoders = stages
+    encoder_settings = encoder_settings or {}
+    cv = CVManager(tile_pixels=tile_pixels)
+    pixels = sorted(width * height for width, height in
+                    (size for size in (cv.image_size(path) for path, _ in items) if size and not cv.is_large(size)))
+    # Images without a readable header fall back to an export of their own if they do not fit
+    frame_pixels = pixels[int(SLOT_PERCENTILE * (len(pixels) - 1) + 0.5)] if pixels else OUTPUT_BYTES // 3
+    if slot_pixels:
+        frame_pixels = min(frame_pixels, int(slot_pixels))
+    frame_bytes = frame_pixels * 3
+    context = multiprocessing.get_context()
+    frames = FrameRing(2 * decoders + renderers + (2 * encoders if native else 0), frame_bytes, context)
+    outputs = None if native else FrameRing(renderers + 2 * encoders, OUTPUT_BYTES, context)
+    sources, decoded, rendered, results = (context.Queue() for _ in range(4))
+    processes = ([context.Process(target=decode_stage, daemon=True,
+                                  args=(sources, decoded, results, frames, layout, folder, encoder_settings, native,
+                                        tile_pixels, auto_place)) for _ in range(decoders)] +
+                 [context.Process(target=render_stage, daemon=True,
+                                  args=(decoded, rendered, results, (frames, outputs), layout, native, auto_place))
+                  for _ in range(renderers)] +
+                 [context.Process(target=encode_stage, daemon=True,
+                                  args=(rendered, results, (frames, outputs), folder, encoder_settings))
+                  for _ in range(encoders)])
+    for process in processes:
+        process.start()
+    for index, (path, name) in enumerate(items):
+        sources.put((index, path, name))
+    for _ in range(decoders):
+        sources.put(STOP)
+    done = 0
+    try:
+        while done < len(items):
+            try:
+                _, path = results.get(timeout=1)
+            except queue.Empty:
+                if any(process.exitcode not in (None, 0) for process in processes):
+                    raise RuntimeError('A pipeline worker died')
+                continue
+            done += 1
+            yield path
+    finally:
+        if done < len(items):
+            for process in processes:
+                process.terminate()
+        for _ in range(renderers):
+            decoded.put(STOP)
+        for _ in range(encoders):
+            rendered.put(STOP)
+        for process in processes:
+            process.join()
+        for ring in (frames, outputs):
+            if ring:
+                ring.close(unlink=True)
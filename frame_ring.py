@@ -0,0 +1,62 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+class FrameRing:
+    """ A ring of fixed-size frame slots in one shared memory block, for passing images between processes.
+
+    A frame travels between processes as a small (slot, shape, dtype) descriptor and both sides view
+    the same slot in place, so images are never pickled or copied on the way. Free slot numbers
+    circulate through a queue: `acquire` blocks while every slot is in use, which bounds the frames
+    in flight, and whoever is done with a frame hands its slot back with `release`.
+
+    The ring is created in the parent process and handed to the workers when they start, and the
+    parent removes the block with `close(unlink=True)` once they are gone.
+    """
+
+    def __init__(self, slots, slot_bytes, context):
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.memory = shared_memory.SharedMemory(create=True, size=max(1, slots * slot_bytes))
+        self.free = context.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+
+    def __getstate__(self):
+        # Spawned workers attach to the block by name instead of receiving its contents
+        return {'slots': self.slots, 'slot_bytes': self.slot_bytes, 'name': self.memory.name, 'free': self.free}
+
+    def __setstate__(self, state):
+        self.slots = state['slots']
+        self.slot_bytes = state['slot_bytes']
+        self.free = state['free']
+        self.memory = shared_memory.SharedMemory(name=state['name'])
+
+    def fits(self, shape, dtype=np.uint8):
+        return int(np.prod(shape)) * np.dtype(dtype).itemsize <= self.slot_bytes
+
+    def acquire(self):
+        """ Take a free slot, waiting for one if the ring is full. """
+        return self.free.get()
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    def view(self, slot, shape, dtype=np.uint8):
+        """ Get an array over a slot, shared with every process that views the same slot. """
+        return np.ndarray(shape, dtype=dtype, buffer=self.memory.buf, offset=slot * self.slot_bytes)
+
+    def descriptor(self, slot, frame):
+        """ Get the picklable (slot, shape, dtype) a frame viewed with `view` travels as. """
+        return slot, frame.shape, frame.dtype.str
+
+    def frame(self, descriptor):
+        """ View the frame a descriptor refers to. """
+        slot, shape, dtype = descriptor
+        return self.view(slot, shape, dtype)
+
+    def close(self, unlink=False):
+        """ Detach from the block, and with `unlink` free it. Views of the slots must be gone by now. """
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
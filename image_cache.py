@@ -0,0 +1,47 @@
+import threading
+from collections import OrderedDict
+
+
+class ImageCache:
+    """ Thread-safe LRU cache of decoded images, bounded by their total size in bytes. """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, loader):
+        """ Get the cached image for key, loading and caching it with loader(key) on a miss. """
+        image = self.peek(key)
+        if image is not None:
+            return image
+        # Decode outside the lock so other threads can keep hitting the cache
+        image = loader(key)
+        if image is not None and image.nbytes <= self.max_bytes:
+            with self.lock:
+                if key not in self.images:
+                    self.images[key] = image
+                    self.size += image.nbytes
+                while self.size > self.max_bytes:
+                    self.size -= self.images.popitem(last=False)[1].nbytes
+        return image
+
+    def peek(self, key):
+        """ Get the cached image for key without loading it, or None on a miss. """
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+            return image
+
+    def discard(self, key):
+        with self.lock:
+            image = self.images.pop(key, None)
+            if image is not None:
+                self.size -= image.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.size = 0
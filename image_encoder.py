@@ -0,0 +1,61 @@
+import os
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import bounded_map
+
+# File extension, OpenCV write flag, default level and highest level of each supported output format
+ENCODER_FORMATS = {
+    'png': ('.png', cv2.IMWRITE_PNG_COMPRESSION, 1, 9),
+    'jpeg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY, 92, 100),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY, 90, 100),
+}
+
+
+class ImageEncoder:
+    """ Encode images to PNG, JPEG or WebP and write them on a thread pool.
+
+    `quality` is the JPEG/WebP quality (0-100) or the PNG compression level (0-9). OpenCV releases the
+    GIL while encoding, so writes on the pool run in parallel.
+    """
+
+    def __init__(self, format='png', quality=None, workers=None):
+        format = 'jpeg' if format.lower() == 'jpg' else format.lower()
+        if format not in ENCODER_FORMATS:
+            raise ValueError(f'Unsupported output format: {format}')
+        self.format = format
+        self.extension, flag, default_quality, max_quality = ENCODER_FORMATS[format]
+        self.quality = default_quality if quality is None else quality
+        if not 0 <= self.quality <= max_quality:
+            raise ValueError(f'{format} quality must be between 0 and {max_quality}')
+        self.params = [flag, self.quality]
+        self.workers = workers or os.cpu_count()
+
+    @property
+    def settings(self):
+        """ Get the settings that affect the encoded output. """
+        return {'format': self.format, 'quality': self.quality}
+
+    def encode(self, image):
+        """ Encode an image to bytes in the configured format. """
+        success, data = cv2.imencode(self.extension, image, self.params)
+        if not success:
+            raise ValueError(f'Could not encode image as {self.format}')
+        return data.tobytes()
+
+    def save(self, path, image_name, image_data):
+        """ Write a single image to the folder and return the file path, raising OSError if it is not written. """
+        file_path = f'{path}/{image_name}{self.extension}'
+        try:
+            written = cv2.imwrite(file_path, image_data, self.params)
+        except cv2.error as error:
+            raise OSError(f'Could not write {file_path}: {error}') from error
+        # OpenCV reports most failures (an unwritable folder, a size the format cannot hold) by returning False
+        if not written:
+            raise OSError(f'Could not write {file_path}')
+        return file_path
+
+    def save_all(self, path, images, window=None):
+        """ Write (image, name) pairs on the thread pool, keeping at most `window` images queued. """
+        window = window or self.workers * 2
+        with ThreadPoolExecutor(self.workers) as executor:
+            return list(bounded_map(executor, lambda image: self.save(path, image[1], image[0]), images, window))
@@ -0,0 +1,64 @@
+import os
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5.QtCore import QObject, pyqtSignal
+
+
+class ImageLoader(QObject):
+    """ Decode images on a worker pool and report each file back to the GUI thread as it completes.
+
+    Signals are emitted from the GUI thread only: worker threads hand results over through the queued
+    `completed` signal, so slots connected to `loaded`, `progress` and `finished` may touch widgets.
+    """
+    loaded = pyqtSignal(str, bool)
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal()
+    completed = pyqtSignal(int, str, bool)
+
+    def __init__(self, load, workers=None):
+        super().__init__()
+        self.load_function = load
+        self.executor = ThreadPoolExecutor(workers or os.cpu_count())
+        self.futures = []
+        self.batch = 0
+        self.done = 0
+        self.total = 0
+        self.completed.connect(self.on_completed)
+
+    @property
+    def is_loading(self):
+        return self.done < self.total
+
+    def load(self, paths):
+        """ Queue paths for decoding, adding them to the batch that is currently loading. """
+        self.total += len(paths)
+        for path in paths:
+            future = self.executor.submit(self.load_function, path)
+            future.add_done_callback(partial(self.on_done, self.batch, path))
+            self.futures.append(future)
+        self.progress.emit(self.done, self.total)
+
+    def cancel(self):
+        """ Drop every queued file and ignore results of the ones already being decoded. """
+        for future in self.futures:
+            future.cancel()
+        self.futures = []
+        self.batch += 1
+        self.done = self.total = 0
+        self.finished.emit()
+
+    def on_done(self, batch, path, future):
+        # Runs on a worker thread, only forward the result to the GUI thread
+        if not future.cancelled():
+            self.completed.emit(batch, path, future.exception() is None and future.result() is not None)
+
+    def on_completed(self, batch, path, success):
+        if batch != self.batch:
+            return
+        self.done += 1
+        self.loaded.emit(path, success)
+        self.progress.emit(self.done, self.total)
+        if self.done == self.total:
+            self.futures = []
+            self.done = self.total = 0
+            self.finished.emit()
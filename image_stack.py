@@ -0,0 +1,36 @@
+import numpy as np
+
+
+class ImageStack:
+    """ Reusable memory for compositing groups of same-size images as (N, H, W, 3) stacks.
+
+    Stacks are views into one flat buffer that only grows, so once it has reached the size of a
+    typical batch no image memory is allocated. Stacks taken since the last `reset` stay valid
+    until the next one, so an ImageStack belongs to one thread at a time.
+    """
+
+    def __init__(self):
+        self.buffer = np.empty(0, dtype=np.uint8)
+        self.scratch_buffer = np.empty(0, dtype=np.uint8)
+        self.used = 0
+
+    def reset(self):
+        """ Hand the whole buffer out again, invalidating the stacks taken so far. """
+        self.used = 0
+
+    def take(self, count, height, width):
+        """ Get an uninitialized (count, height, width, 3) stack. """
+        size = count * height * width * 3
+        if self.used + size > self.buffer.size:
+            # Stacks already taken keep the old buffer alive for as long as they are referenced
+            self.buffer = np.empty(max(self.used + size, 2 * self.buffer.size), dtype=np.uint8)
+            self.used = 0
+        stack = self.buffer[self.used:self.used + size].reshape(count, height, width, 3)
+        self.used += size
+        return stack
+
+    def scratch(self, size):
+        """ Get flat working space of at least `size` bytes, valid until the next call. """
+        if size > self.scratch_buffer.size:
+            self.scratch_buffer = np.empty(size, dtype=np.uint8)
+        return self.scratch_buffer
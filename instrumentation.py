@@ -0,0 +1,137 @@
+import time
+import threading
+import contextlib
+import tracemalloc
+
+# Handed out for every stage while instrumentation is off
+NO_STAGE = contextlib.nullcontext()
+
+
+class StageTimer:
+    __slots__ = ('instruments', 'name', 'start')
+
+    def __init__(self, instruments, name):
+        self.instruments = instruments
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instruments.add(self.name, time.perf_counter() - self.start)
+
+
+class ProfileData:
+    """ Raw cProfile statistics in the form pstats.Stats can load. """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Instrumentation:
+    """ Per-stage timers and counters, with optional cProfile and tracemalloc capture.
+
+    While disabled every stage is the same shared no-op context, so instrumented code pays for a
+    method call and nothing else. Snapshots taken with drain can be merged into another instance,
+    which is how worker processes report back to the process that started them.
+    """
+
+    def __init__(self, enabled=False, profile=False, trace_memory=False):
+        self.enabled = enabled or profile or trace_memory
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.lock = threading.Lock()
+        # cProfile follows one thread, so only one task is profiled at a time
+        self.profile_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.profile_stats = None
+        self.peak_alloc = 0
+
+    def stage(self, name):
+        """ Get a context that times one run of a stage. """
+        return StageTimer(self, name) if self.enabled else NO_STAGE
+
+    def add(self, name, seconds, count=1):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stage[0] += count
+            stage[1] += seconds
+            stage[2] = max(stage[2], seconds)
+
+    @contextlib.contextmanager
+    def profiled(self):
+        """ Profile a block of work with cProfile if profiling is on and no other thread is profiled. """
+        if not self.profile or not self.profile_lock.acquire(blocking=False):
+            yield
+            return
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            yield
+        finally:
+            profiler.disable()
+            profiler.create_stats()
+            self.profile_lock.release()
+            self.merge({'profile': profiler.stats})
+
+    @contextlib.contextmanager
+    def traced(self):
+        """ Record the peak traced allocation of a block of work if memory tracing is on. """
+        if not self.trace_memory or tracemalloc.is_tracing():
+            yield
+            return
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.merge({'peak_alloc': peak})
+
+    def drain(self):
+        """ Get a snapshot of everything recorded so far and start over. """
+        with self.lock:
+            snapshot = {'stages': self.stages, 'peak_alloc': self.peak_alloc,
+                        'profile': self.profile_stats.stats if self.profile_stats else None}
+            self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        """ Add a snapshot from drain, possibly taken in another process. """
+        with self.lock:
+            for name, (count, total, longest) in snapshot.get('stages', {}).items():
+                stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+                stage[0] += count
+                stage[1] += total
+                stage[2] = max(stage[2], longest)
+            self.peak_alloc = max(self.peak_alloc, snapshot.get('peak_alloc', 0))
+            if snapshot.get('profile'):
+                profile = ProfileData(snapshot['profile'])
+                if self.profile_stats is None:
+                    import pstats
+                    self.profile_stats = pstats.Stats(profile)
+                else:
+                    self.profile_stats.add(profile)
+
+    def summary(self, top=20):
+        """ Get the stage timings, and the peak allocation and top functions when captured, as a dict. """
+        with self.lock:
+            summary = {'stages': {name: {'count': count, 'total_ms': round(total * 1000, 3),
+                                         'mean_ms': round(total / count * 1000, 3), 'max_ms': round(longest * 1000, 3)}
+                                  for name, (count, total, longest) in self.stages.items()}}
+            if self.peak_alloc:
+                summary['peak_alloc_mb'] = round(self.peak_alloc / 2 ** 20, 3)
+            if self.profile_stats:
+                functions = sorted(self.profile_stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+                summary['profile'] = [{'function': f'{file}:{line}({name})', 'calls': calls,
+                                       'own_ms': round(own * 1000, 3), 'cumulative_ms': round(cumulative * 1000, 3)}
+                                      for (file, line, name), (_, calls, own, cumulative, _) in functions[:top]]
+        return summary
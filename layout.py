@@ -0,0 +1,129 @@
+import json
+import base64
+import hashlib
+import cv2
+import numpy as np
+
+LAYOUT_VERSION = 1
+
+
+class TextWatermark:
+    """ A text watermark with its position as fractions of the canvas size, None while in the editor. """
+    __slots__ = ('text', 'color', 'font', 'size', 'bold', 'position')
+
+    def __init__(self, text, color, font, size, bold, position=None):
+        self.text = text
+        self.color = tuple(color)
+        self.font = font
+        self.size = size
+        self.bold = bold
+        self.position = position
+
+    def moved(self, position):
+        """ Get a copy of the watermark at another position. """
+        return TextWatermark(self.text, self.color, self.font, self.size, self.bold, position)
+
+    def to_dict(self):
+        return {'type': 'text', 'text': self.text, 'color': self.color, 'font': self.font, 'size': self.size,
+                'bold': self.bold, 'position': self.position}
+
+
+class ImageWatermark:
+    """ An image watermark with its position as fractions of the canvas size, None while in the editor. """
+    __slots__ = ('image', 'position')
+
+    def __init__(self, image, position=None):
+        self.image = image
+        self.position = position
+
+    def moved(self, position):
+        """ Get a copy of the watermark at another position, sharing its image. """
+        return ImageWatermark(self.image, position)
+
+    def to_dict(self):
+        png = cv2.imencode('.png', self.image)[1].tobytes()
+        return {'type': 'image', 'image': base64.b64encode(png).decode('ascii'), 'position': self.position}
+
+
+class WatermarkLayout:
+    """ A serializable watermark layout, independent of the editor widgets.
+
+    Positions are stored as fractions of the canvas the layout was made on, so a layout can be drawn
+    onto a canvas of any size. `content_hash` identifies the rendered result and is computed once.
+    """
+    __slots__ = ('objects', 'canvas_size', 'scalar', '_content_hash')
+
+    def __init__(self, objects, canvas_size, scalar=1):
+        self.objects = objects
+        self.canvas_size = tuple(canvas_size)
+        self.scalar = scalar
+        self._content_hash = None
+
+    @classmethod
+    def from_objects(cls, watermark_objects, canvas_size, scalar=1):
+        """ Build a layout from the editor's (watermark, selection position) pairs on a (width, height) canvas. """
+        width, height = canvas_size
+        objects = [watermark.moved(((x0 / width, y0 / height), (x1 / width, y1 / height)))
+                   for watermark, ((x0, y0), (x1, y1)) in watermark_objects]
+        return cls(objects, (width, height), scalar)
+
+    def to_objects(self, canvas_size=None):
+        """ Get the editor's (watermark, selection position) pairs, in pixels of the given canvas size. """
+        width, height = canvas_size or self.canvas_size
+        return [(watermark.moved(None), self.pixel_position(watermark, (width, height)))
+                for watermark in self.objects]
+
+    def pixel_position(self, watermark, canvas_size=None):
+        """ Get the ((x0, y0), (x1, y1)) of one of the layout's watermarks in pixels of the given canvas size. """
+        width, height = canvas_size or self.canvas_size
+        (x0, y0), (x1, y1) = watermark.position
+        return (round(x0 * width), round(y0 * height)), (round(x1 * width), round(y1 * height))
+
+    @property
+    def content_hash(self):
+        if self._content_hash is None:
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(repr((LAYOUT_VERSION, self.canvas_size, self.scalar)).encode())
+            for watermark in self.objects:
+                if isinstance(watermark, TextWatermark):
+                    digest.update(json.dumps(watermark.to_dict()).encode())
+                else:
+                    digest.update(repr((watermark.image.shape, watermark.position)).encode())
+                    digest.update(np.ascontiguousarray(watermark.image).data)
+            self._content_hash = digest.hexdigest()
+        return self._content_hash
+
+    def to_dict(self):
+        return {'version': LAYOUT_VERSION, 'canvas_size': self.canvas_size, 'scalar': self.scalar,
+                'objects': [watermark.to_dict() for watermark in self.objects]}
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict):
+            raise ValueError('A layout is a JSON object')
+        if data.get('version') != LAYOUT_VERSION:
+            raise ValueError(f'Unsupported layout version: {data.get("version")}')
+        objects = []
+        for item in data['objects']:
+            position = tuple(tuple(point) for point in item['position'])
+            if item['type'] == 'text':
+                objects.append(TextWatermark(item['text'], item['color'], item['font'], item['size'], item['bold'],
+                                             position))
+            else:
+                png = np.frombuffer(base64.b64decode(item['image']), dtype=np.uint8)
+                objects.append(ImageWatermark(cv2.imdecode(png, cv2.IMREAD_COLOR), position))
+        return cls(objects, data['canvas_size'], data['scalar'])
+
+    def save(self, path):
+        """ Save the layout to a JSON file, with image watermarks embedded as PNG. """
+        with open(path, 'w') as layout_file:
+            json.dump(self.to_dict(), layout_file)
+
+    @classmethod
+    def load(cls, path):
+        """ Load a layout saved with save, raising ValueError if the file is not one. """
+        with open(path) as layout_file:
+            try:
+                return cls.from_dict(json.load(layout_file))
+            except (ValueError, KeyError, TypeError) as error:
+                raise ValueError(f'{path} is not a PyMark layout: {error!r}') from error
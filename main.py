@@ -1,8 +1,13 @@
-import cv2
+import time
 import numpy as np
 from ui_manager import UIManager
-from cv_manager import CVManager
-from PyQt5.QtCore import Qt, QSize
+from image_cache import ImageCache
+from image_loader import ImageLoader
+from render_scheduler import RenderScheduler
+from edit_history import EditHistory
+from canvas_compositor import CanvasCompositor, union_rect, clip_rect
+from instrumentation import Instrumentation
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QColor, QIcon
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QLayout, QHBoxLayout, QVBoxLayout, QListWidget, \
     QListWidgetItem, QFileDialog, QLabel, QColorDialog
@@ -22,12 +27,26 @@ class Core(QMainWindow):
         # Core attributes
         self.app = app
         self.ui = UIManager()
-        self.cv = CVManager()
+        self._cv = None
         # Image attributes
         self.image_list = []
+        self.export_window = 4
+        self.export_encoder = None
+        self.export_formats = []
+        self.format_combo = None
+        self.preview_cache = ImageCache(256 * 2 ** 20)
+        self.image_loader = ImageLoader(self.load_preview_proxy)
+        self.image_loader.loaded.connect(self.add_loaded_image)
+        self.image_loader.progress.connect(self.show_load_progress)
+        self.image_loader.finished.connect(self.hide_load_progress)
+        self.preview_loader = ImageLoader(self.load_preview_proxy, workers=1)
+        self.preview_loader.loaded.connect(self.show_loaded_preview)
+        self.load_progress = None
+        self.cancel_load_button = None
         self.image_list_widget = None
         self.watermark_canvas = None
         # Watermark attributes
+        self.watermark_size = (450, 150)
         self.watermark = np.full([150, 450, 3], (255, 255, 255), dtype=np.uint8)
         self.watermark_copy = self.watermark.copy()
         self.watermark_objects = []
@@ -42,13 +61,36 @@ class Core(QMainWindow):
         self.text_color = (0, 0, 0)
         self.text_mode = False
         self.color_picker = None
+        self.compositor = None
+        self.history = EditHistory()
+        self.drag_entry = None
+        self.canvas_frame = None
+        self.canvas_dirty = None
         # Preview attributes
         self.preview_canvas = None
         self.preview_image = np.full([300, 600, 3], (255, 255, 255), dtype=np.uint8)
         self.preview_scale = 1
+        self.render_scheduler = RenderScheduler(self.render_frame)
 
         self.loadUI()
 
+    @property
+    def cv(self):
+        if self._cv is None:
+            self.load_core()
+        return self._cv
+
+    # Load OpenCV and the imaging core, which is left until first use or until the window has been painted
+    def load_core(self):
+        if self._cv is not None:
+            return
+        from cv_manager import CVManager
+        from image_encoder import ENCODER_FORMATS
+        self._cv = CVManager()
+        self.export_formats = list(ENCODER_FORMATS)
+        # Filling the combo selects the first format through set_export_format
+        self.format_combo.addItems(self.export_formats)
+
     def loadUI(self):
         # Central widget setup
         central_widget = QWidget()
@@ -68,6 +110,10 @@ class Core(QMainWindow):
         self.ui.create_button(file_button_layout, self.add_preview_images, icon='assets/add.png', text='')
         self.ui.create_button(file_button_layout, self.delete_preview_image, icon='assets/delete.png', text='')
         self.ui.create_button(file_button_layout, self.save_images, icon='assets/save.png', text='')
+        self.format_combo = self.ui.create_combo(file_button_layout, self.set_export_format, (70, 25), [])
+        self.cancel_load_button = self.ui.create_button(file_button_layout, self.image_loader.cancel, 'Cancel')
+        self.cancel_load_button.hide()
+        self.load_progress = self.ui.create_progress_bar(left_layout, 300, 15)
 
         self.image_list_widget = self.ui.create_list_widget(left_layout, 300, 600, self.set_preview_image)
 
@@ -87,41 +133,59 @@ class Core(QMainWindow):
         self.ui.create_combo(watermark_tools_layout, self.set_text_size, (70, 25),
                              ['x-small', 'small', 'medium', 'large'])
         self.ui.create_button(watermark_tools_layout, self.reset_watermark_canvas, '', 'assets/reset.png')
+        self.ui.create_button(watermark_tools_layout, self.save_layout, 'Save layout')
+        self.ui.create_button(watermark_tools_layout, self.load_layout, 'Load layout')
+        self.ui.create_button(watermark_tools_layout, self.undo, 'Undo')
+        self.ui.create_button(watermark_tools_layout, self.redo, 'Redo')
         watermark_canvas_layout = self.ui.create_layout(right_layout, 'h', Qt.AlignLeft, (0, 0, 0, 0))
-        self.watermark_canvas = self.ui.create_canvas(watermark_canvas_layout, 450, 150, self.watermark)
+        self.watermark_canvas = self.ui.create_canvas(watermark_canvas_layout, *self.watermark_size, self.watermark)
         radio_layout = self.ui.create_layout(watermark_canvas_layout, 'v', bounds=(25, 0, 0, 0))
         self.ui.create_radio(radio_layout, 'Watermark scale', self.set_preview_scale, ['small', 'medium', 'large'])
         right_layout.addStretch(1)
         self.ui.create_text(right_layout, 'Preview Image:')
         self.preview_canvas = self.ui.create_canvas(right_layout, 600, 300, self.preview_image)
+        # Frame time readout, toggled with F12
+        self.frame_time_label = self.ui.create_text(right_layout, '', 9)
+        self.frame_time_label.hide()
+        # Stage timings of the last export, also toggled with F12
+        self.export_time_label = self.ui.create_text(right_layout, '', 9)
+        self.export_time_label.hide()
 
     # Event handlers
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self._cv is None:
+            # Queued behind this paint, so the window shows without waiting for the imaging core
+            QTimer.singleShot(0, self.load_core)
+
     def mouseMoveEvent(self, event):
         if self.watermark_canvas.underMouse():
             mouse_pos = self.relative_position(self.watermark_canvas, (event.x(), event.y()))
             if self.selection is not None:
-                if self.is_hover(mouse_pos, self.selection_pos):
+                if self.is_hover(mouse_pos, self.text_box() if self.text_mode else self.selection_pos):
                     self.app.setOverrideCursor(Qt.SizeAllCursor)
                 else:
                     self.app.setOverrideCursor(Qt.ArrowCursor)
                 if self.selection_move == 'obj' and self.is_hover(mouse_pos, (
                         (0, 0), (self.watermark_canvas.width(), self.watermark_canvas.height()))):
-                    self.watermark_copy = self.watermark.copy()
                     x_gap, y_gap = self.cv.getGap(self.start_pos, mouse_pos)
                     self.selection_pos = (
                         (self.selection_pos[0][0] + (x_gap * -1), self.selection_pos[0][1] + (y_gap * -1)),
                         (self.selection_pos[1][0] + (x_gap * -1), self.selection_pos[1][1] + (y_gap * -1)))
-                    self.watermark, self.selection_pos = self.cv.move_selection(self.watermark, self.selection,
-                                                                                self.selection_pos,
-                                                                                self.watermark_canvas.size())
-                    self.cv.mark_selection(self.watermark, self.selection_pos)
+
+                    def paint(frame):
+                        _, self.selection_pos = self.cv.move_selection(frame, self.selection, self.selection_pos,
+                                                                       self.watermark_size)
+                        self.cv.mark_selection(frame, self.selection_pos)
+                        return self.selection_rect()
+
+                    # Only the old and new selection rects are redrawn, the committed canvas is left as is
+                    dirty_rect = self.compositor.update(paint)
                     self.watermark_objects[-1] = (self.watermark_objects[-1][0], self.selection_pos)
-                    self.render_watermark()
-                    self.watermark = self.watermark_copy.copy()
+                    self.render_watermark(self.compositor.frame, dirty_rect)
                     self.start_pos = mouse_pos
                 elif self.selection_move == 'text' and self.is_hover(mouse_pos, (
                 (0, 0), (self.watermark_canvas.width(), self.watermark_canvas.height()))):
-                    self.watermark_copy = self.watermark.copy()
                     x_gap, y_gap = self.cv.getGap(self.start_pos, mouse_pos)
                     self.selection_pos = (
                         (self.selection_pos[0][0] + (x_gap * -1), self.selection_pos[0][1] + (y_gap * -1)),
@@ -140,17 +204,14 @@ class Core(QMainWindow):
                         self.selection_pos = ((self.selection_pos[0][0], self.watermark_canvas.height() - 10 - (
                                 self.selection_pos[1][1] - self.selection_pos[0][1])),
                                               (self.selection_pos[1][0], self.watermark_canvas.height() - 10))
-                    cv2.putText(self.watermark, self.text, (self.selection_pos[0][0], self.selection_pos[1][1]),
-                                self.text_font, 0.5 * self.text_size, self.text_color, 2 if self.text_bold else 1)
-                    start_pos, end_pos = self.selection_pos
-                    start_pos = (start_pos[0], start_pos[1] - 2 * self.text_size)
-                    end_pos = (
-                        start_pos[0] + (len(self.text) * (10 * self.text_size) - (0 if self.text_size == 1 else 0)),
-                        end_pos[1] + 2 * self.text_size)
-                    self.cv.mark_selection(self.watermark, (start_pos, end_pos))
+
+                    def paint(frame):
+                        self.draw_text_selection(frame)
+                        return self.selection_rect()
+
+                    dirty_rect = self.compositor.update(paint)
                     self.watermark_objects[-1] = (self.watermark_objects[-1][0], self.selection_pos)
-                    self.render_watermark()
-                    self.watermark = self.watermark_copy.copy()
+                    self.render_watermark(self.compositor.frame, dirty_rect)
                     self.start_pos = mouse_pos
                 else:
                     self.selection_move = False
@@ -159,34 +220,41 @@ class Core(QMainWindow):
         if self.watermark_canvas.underMouse():
             mouse_pos = self.relative_position(self.watermark_canvas, (event.x(), event.y()))
             if self.selection is not None:
-                if self.is_hover(mouse_pos, self.selection_pos):
+                # Text is hit-tested against the pixels it covers, not its stored position
+                if self.is_hover(mouse_pos, self.text_box() if self.text_mode else self.selection_pos):
                     if self.text_mode:
                         self.selection_move = 'text'
                     else:
                         self.selection_move = 'obj'
                     self.start_pos = mouse_pos
+                    # The drag composites the selection over the canvas as it is now, without the selection
+                    self.compositor = CanvasCompositor(self.watermark, self.selection_rect())
+                    self.drag_entry = self.watermark_objects[-1]
                 else:
-                    if self.text_mode:
-                        self.text_mode = False
-                        cv2.putText(self.watermark, self.text, (self.selection_pos[0][0], self.selection_pos[1][1]),
-                                    self.text_font, 0.5 * self.text_size, self.text_color, 2 if self.text_bold else 1)
-                        self.text = 'text'
-                        self.watermark_copy = self.watermark.copy()
-                    else:
-                        self.watermark, self.selection_pos = self.cv.move_selection(self.watermark, self.selection,
-                                                                                    self.selection_pos,
-                                                                                    self.watermark_canvas.size())
-                    self.selection = None
-                    self.selection_pos = None
-                    self.render_watermark()
+                    self.commit_selection()
 
     def mouseReleaseEvent(self, event):
         if self.watermark_canvas.underMouse():
             mouse_pos = self.relative_position(self.watermark_canvas, (event.x(), event.y()))
             if self.selection is not None:
+                # A whole drag is recorded as one move
+                if self.selection_move and self.drag_entry[1] != self.watermark_objects[-1][1]:
+                    self.history.record('move', len(self.watermark_objects) - 1, self.drag_entry,
+                                        self.watermark_objects[-1])
                 self.selection_move = False
+                self.compositor = None
+                self.drag_entry = None
 
     def keyPressEvent(self, event):
+        if event.key() == Qt.Key_F12:
+            self.toggle_stats()
+            return
+        if event.modifiers() & Qt.ControlModifier:
+            if event.key() == Qt.Key_Z:
+                self.redo() if event.modifiers() & Qt.ShiftModifier else self.undo()
+            elif event.key() == Qt.Key_Y:
+                self.redo()
+            return
         if self.text_mode:
             if self.text == 'text':
                 self.text = ''
@@ -198,55 +266,114 @@ class Core(QMainWindow):
                 self.text += chr(event.key())
             else:
                 return
-            cv2.putText(self.watermark, self.text, (self.selection_pos[0][0], self.selection_pos[1][1]),
-                        self.text_font, 0.5 * self.text_size, self.text_color, 2 if self.text_bold else 1)
-            start_pos, end_pos = self.selection_pos
-            start_pos = (start_pos[0], start_pos[1] - 2 * self.text_size)
-            end_pos = (start_pos[0] + (len(self.text) * (10 * self.text_size) - (0 if self.text_size == 1 else 0)),
-                       end_pos[1] + 2 * self.text_size)
-            self.cv.mark_selection(self.watermark, (start_pos, end_pos))
-            self.selection_pos = (self.selection_pos[0], (end_pos[0], self.selection_pos[1][1]))
-            self.watermark_objects[-1] = (
-                (self.selection, (self.text_color, self.text_font, self.text_size, self.text,self.text_bold)), self.selection_pos)
+            before = self.watermark_objects[-1]
+            self.draw_text_selection(self.watermark)
+            self.watermark_objects[-1] = (self.text_watermark(), self.selection_pos)
+            # Typing into the same text is undone in one step
+            self.history.record('restyle', len(self.watermark_objects) - 1, before, self.watermark_objects[-1],
+                                merge=True)
             self.render_watermark()
             self.watermark = self.watermark_copy.copy()
 
     def set_preview_image(self, image_index):
-        image = self.image_list[int(image_index)]
-        image = cv2.resize(image, (600, 300))
-        self.preview_image = image
-        self.render_preview()
+        if 0 <= image_index < len(self.image_list):
+            # Previews come from reduced-resolution proxies, evicted ones are decoded again in the background
+            image = self.preview_cache.peek(self.image_list[image_index])
+            if image is None:
+                self.load_core()
+                self.preview_loader.load([self.image_list[image_index]])
+            else:
+                self.preview_image = image
+                self.render_preview()
+
+    def show_loaded_preview(self, path, loaded):
+        row = self.image_list_widget.currentRow()
+        if loaded and 0 <= row < len(self.image_list) and self.image_list[row] == path:
+            self.set_preview_image(row)
+
+    # Runs on loader threads, which are only started once load_core has run on the GUI thread
+    def load_preview_proxy(self, path):
+        return self.preview_cache.get(path, self._cv.load_proxy)
 
     def render_preview(self):
-        preview_copy = self.preview_image.copy()
-        preview_copy = self.cv.draw_watermarks(preview_copy, self.watermark_objects, self.watermark_canvas.size(),
-                                               self.preview_scale)
-        self.preview_canvas.setPixmap(self.ui.to_pixmap(preview_copy))
+        # draw_watermarks resizes into a new array, so the cached preview image is left untouched
+        preview_copy = self.cv.draw_watermarks(self.preview_image, self.watermark_objects,
+                                               self.watermark_size, self.preview_scale)
+        self.preview_canvas.set_image(preview_copy)
 
     def add_preview_images(self):
         dialog = QFileDialog(self)
-        image_paths = dialog.getOpenFileNames(caption='Open Images', filter='Images *.png *.jpg *.jpeg')[0]
+        image_paths = dialog.getOpenFileNames(caption='Open Images', filter='Images *.png *.jpg *.jpeg *.tif *.tiff')[0]
         if image_paths:
-            image_names = [name[0].split('.')[0] for name in [name.split('/')[-1:] for name in image_paths]]
-            for name in image_names:
-                self.image_list_widget.addItem(QListWidgetItem(name))
-            for path in image_paths:
-                self.image_list.append(self.cv.load_image(path))
+            # Proxies are decoded on the loader pool and the list fills in as each one is ready
+            self.load_core()
+            self.image_loader.load(image_paths)
+
+    def add_loaded_image(self, path, loaded):
+        if loaded:
+            # Only paths are kept, images are decoded when previewed or exported
+            self.image_list.append(path)
+            self.image_list_widget.addItem(QListWidgetItem(path.split('/')[-1].split('.')[0]))
+
+    def show_load_progress(self, done, total):
+        self.load_progress.setMaximum(total)
+        self.load_progress.setValue(done)
+        self.load_progress.show()
+        self.cancel_load_button.show()
+
+    def hide_load_progress(self):
+        self.load_progress.hide()
+        self.cancel_load_button.hide()
 
     def save_images(self):
         if self.image_list and self.watermark_objects:
             folder = QFileDialog.getExistingDirectory(caption='Select Folder')
-            ready_images = []
-            for index, image in enumerate(self.image_list):
-                image = self.cv.draw_watermarks(image, self.watermark_objects, self.watermark_canvas.size(),
-                                                self.preview_scale)
-                ready_images.append((image, self.image_list_widget.item(index).text()))
-            self.cv.save_images(folder, ready_images)
+            if folder:
+                image_names = [self.image_list_widget.item(index).text() for index in range(len(self.image_list))]
+                # Drop what preview renders and earlier exports recorded, so only this export is measured
+                self.cv.instruments.drain()
+                self.cv.export_images(folder, self.image_list, image_names, self.watermark_objects,
+                                      self.watermark_size, self.preview_scale, self.export_window,
+                                      self.export_encoder)
+                if self.cv.instruments.enabled:
+                    # Mean time per image of each export stage
+                    stages = self.cv.instruments.drain()['stages']
+                    self.export_time_label.setText('export ' + ' · '.join(
+                        f'{name} {total / count * 1000:.1f} ms' for name, (count, total, _) in stages.items()))
+
+    def set_export_format(self, format_index):
+        from image_encoder import ImageEncoder
+        self.export_encoder = ImageEncoder(self.export_formats[format_index])
+
+    def save_layout(self):
+        if self.watermark_objects:
+            path = QFileDialog.getSaveFileName(caption='Save layout', filter='PyMark layout *.pmk')[0]
+            if path:
+                from layout import WatermarkLayout
+                WatermarkLayout.from_objects(self.watermark_objects, self.watermark_size,
+                                             self.preview_scale).save(path)
+
+    def load_layout(self):
+        path = QFileDialog.getOpenFileName(caption='Load layout', filter='PyMark layout *.pmk')[0]
+        if path:
+            from layout import WatermarkLayout
+            layout = WatermarkLayout.load(path)
+            self.reset_watermark_canvas()
+            # Layout positions are relative, so they are placed on the canvas at its current size
+            self.watermark_objects = layout.to_objects(self.watermark_size)
+            self.history.clear()
+            self.watermark = self.cv.draw_canvas(self.watermark, self.watermark_objects, self.watermark_size)
+            self.watermark_copy = self.watermark.copy()
+            self.render_watermark()
 
     def delete_preview_image(self):
-        if self.image_list:
-            self.image_list_widget.takeItem(self.image_list_widget.currentIndex().row())
-            del self.image_list[self.image_list_widget.currentIndex().row()]
+        row = self.image_list_widget.currentIndex().row()
+        # The row is -1 while nothing is selected
+        if self.image_list and row >= 0:
+            path = self.image_list.pop(row)
+            self.preview_cache.discard(path)
+            self.cv.image_cache.discard(path)
+            self.image_list_widget.takeItem(row)
             if not self.image_list:
                 self.preview_image = np.full([300, 600, 3], (255, 255, 255), dtype=np.uint8)
                 self.render_preview()
@@ -261,9 +388,115 @@ class Core(QMainWindow):
             self.preview_scale = 1
         self.render_preview()
 
-    def render_watermark(self):
-        self.watermark_canvas.setPixmap(self.ui.to_pixmap(self.watermark))
+    def render_watermark(self, frame=None, rect=None):
+        frame = self.watermark if frame is None else frame
+        # Dirty rects add up until the next render, a new frame or a full update repaints everything
+        if rect is None or frame is not self.canvas_frame:
+            rect = (0, 0, frame.shape[1], frame.shape[0])
+        self.canvas_dirty = union_rect(self.canvas_dirty, rect)
+        self.canvas_frame = frame
+        # Drags and typing request renders faster than the display refreshes, only the latest frame is drawn
+        self.render_scheduler.request(frame)
+
+    def render_frame(self, watermark):
+        if not self.cv.instruments.enabled:
+            self.watermark_canvas.set_image(watermark, self.canvas_dirty)
+            self.canvas_dirty = None
+            self.render_preview()
+            return
+        start = time.perf_counter()
+        self.watermark_canvas.set_image(watermark, self.canvas_dirty)
+        self.canvas_dirty = None
+        canvas_time = time.perf_counter()
         self.render_preview()
+        preview_time = time.perf_counter()
+        self.frame_time_label.setText(f'canvas {(canvas_time - start) * 1000:.1f} ms · '
+                                      f'preview {(preview_time - canvas_time) * 1000:.1f} ms')
+
+    # Show frame times and collect export stage timings
+    def toggle_stats(self):
+        enabled = not self.cv.instruments.enabled
+        self.cv.instruments = Instrumentation(enabled)
+        self.frame_time_label.setText('')
+        self.frame_time_label.setVisible(enabled)
+        self.export_time_label.setText('')
+        self.export_time_label.setVisible(enabled)
+
+    def selection_rect(self):
+        """ Get the canvas rect covered by the selection, including its text and marking lines. """
+        (x0, y0), (x1, y1) = self.selection_pos
+        margin = 6
+        if self.text_mode:
+            (box_x0, box_y0), (box_x1, box_y1) = self.text_box()
+            x0, y0, x1, y1 = min(x0, box_x0), min(y0, box_y0), max(x1, box_x1), max(y1, box_y1)
+        return x0 - margin, y0 - margin, x1 - x0 + 2 * margin, y1 - y0 + 2 * margin
+
+    def text_box(self):
+        """ Get the marking box of the selection text, measured from the pixels the text covers. """
+        (x0, y0), (x1, y1) = self.selection_pos
+        x, y, width, height = self.cv.text_renderer.text_rect(self.text, (x0, y1), self.text_font,
+                                                              0.5 * self.text_size, self.text_color,
+                                                              2 if self.text_bold else 1)
+        if not width:
+            return (x0, y0), (x0 + 2, y1)
+        return (x - 2, y - 2), (x + width + 1, y + height + 1)
+
+    def draw_text_selection(self, image):
+        """ Draw the selection text with its marking box and fit the selection width to the text. """
+        (x0, y0), (x1, y1) = self.selection_pos
+        self.cv.text_renderer.draw(image, self.text, (x0, y1), self.text_font, 0.5 * self.text_size,
+                                   self.text_color, 2 if self.text_bold else 1)
+        start_pos, end_pos = self.text_box()
+        self.cv.mark_selection(image, (start_pos, end_pos))
+        self.selection_pos = ((x0, y0), (end_pos[0], y1))
+
+    def undo(self):
+        operation = self.history.undo()
+        if operation:
+            self.apply_entry(operation.index, operation.after, operation.before)
+
+    def redo(self):
+        operation = self.history.redo()
+        if operation:
+            self.apply_entry(operation.index, operation.before, operation.after)
+
+    def apply_entry(self, index, current, target):
+        """ Swap one layout entry for another and redraw only the canvas rect the two cover. """
+        self.commit_selection()
+        if current is None:
+            self.watermark_objects.insert(index, target)
+        elif target is None:
+            del self.watermark_objects[index]
+        else:
+            self.watermark_objects[index] = target
+        rect = None
+        for entry in (current, target):
+            if entry is not None:
+                rect = union_rect(rect, self.cv.canvas_rect(*entry))
+        rect = clip_rect(rect, self.watermark.shape) if rect else None
+        if rect:
+            self.cv.redraw_canvas(self.watermark, self.watermark_objects, rect)
+            self.watermark_copy = self.watermark.copy()
+            self.render_watermark(self.watermark, rect)
+
+    def commit_selection(self):
+        # Draw the selection into the canvas and leave nothing selected
+        if self.selection is None:
+            return
+        if self.text_mode:
+            self.text_mode = False
+            self.cv.text_renderer.draw(self.watermark, self.text, (self.selection_pos[0][0], self.selection_pos[1][1]),
+                                       self.text_font, 0.5 * self.text_size, self.text_color,
+                                       2 if self.text_bold else 1)
+            self.text = 'text'
+            self.watermark_copy = self.watermark.copy()
+        else:
+            self.watermark, self.selection_pos = self.cv.move_selection(self.watermark, self.selection,
+                                                                        self.selection_pos,
+                                                                        self.watermark_size)
+        self.selection = None
+        self.selection_pos = None
+        self.render_watermark()
 
     def reset_watermark_canvas(self):
         self.selection = None
@@ -271,6 +504,7 @@ class Core(QMainWindow):
         self.text_mode = None
         self.selection_move = False
         self.watermark_objects = []
+        self.history.clear()
         self.watermark = np.full([150, 450, 3], (255, 255, 255), dtype=np.uint8)
         self.watermark_copy = self.watermark.copy()
         self.render_watermark()
@@ -286,17 +520,19 @@ class Core(QMainWindow):
             if self.watermark_objects:
                 self.watermark_copy = self.watermark.copy()
             self.selection = self.cv.load_image(image_path)
-            self.watermark, self.selection = self.cv.fitImage(self.selection, self.watermark_canvas,
+            self.watermark, self.selection = self.cv.fitImage(self.selection, self.watermark_size,
                                                               background_image=self.watermark, gap=(40, 40))
-            self.selection_pos = (self.cv.get_rect(self.watermark_canvas.size(), self.selection))
+            self.selection_pos = (self.cv.get_rect(self.watermark_size, self.selection))
             start_pos, end_pos = self.selection_pos
             start_pos = (start_pos[0] - 1, start_pos[1] - 1)
             self.cv.mark_selection(self.watermark, (start_pos,end_pos))
-            self.watermark_objects.append((self.selection, self.selection_pos))
+            from layout import ImageWatermark
+            self.watermark_objects.append((ImageWatermark(self.selection), self.selection_pos))
+            self.history.record('add', len(self.watermark_objects) - 1, None, self.watermark_objects[-1])
             self.render_watermark()
             self.watermark = self.watermark_copy.copy()
 
-    def add_watermark_text(self, default_text=None):
+    def add_watermark_text(self, default_text=None, record=True):
         if self.selection is not None:
             self.delete_selection()
         if self.watermark_objects:
@@ -309,39 +545,43 @@ class Core(QMainWindow):
         start_pos = (225 - (30 * self.text_size), 70 - (5 * self.text_size))
         end_pos = (225 + ((4 * len(self.text)) * self.text_size), 70 + (5 * self.text_size))
         self.selection_pos = (start_pos, end_pos)
-        cv2.putText(self.watermark, self.text, (start_pos[0], end_pos[1]), self.text_font, 0.5 * self.text_size,
-                    self.text_color, 2 if self.text_bold else 1)
-        start_pos = (start_pos[0], start_pos[1] - 2 * self.text_size)
-        end_pos = (start_pos[0] + (len(self.text) * (10 * self.text_size) - (0 if self.text_size == 1 else 0)),
-                   end_pos[1] + 2 * self.text_size)
-        self.cv.mark_selection(self.watermark, (start_pos, end_pos))
-        self.watermark_objects.append(
-            ((self.selection, (self.text_color, self.text_font, self.text_size, self.text,self.text_bold)), self.selection_pos))
+        self.draw_text_selection(self.watermark)
+        self.watermark_objects.append((self.text_watermark(), self.selection_pos))
+        if record:
+            self.history.record('add', len(self.watermark_objects) - 1, None, self.watermark_objects[-1])
         self.render_watermark()
         self.watermark = self.watermark_copy.copy()
 
+    # The selection text in the current style, as a layout entry
+    def text_watermark(self):
+        from layout import TextWatermark
+        return TextWatermark(self.text, self.text_color, self.text_font, self.text_size, self.text_bold)
+
+    def restyle_selection(self):
+        # Redraw the selection text in the current style, recorded as a single restyle
+        index = len(self.watermark_objects) - 1
+        before = self.watermark_objects[index]
+        saved_text = self.text
+        self.remove_selection()
+        self.add_watermark_text(saved_text, record=False)
+        self.history.record('restyle', index, before, self.watermark_objects[index])
+
     def set_text_font(self, font_index):
         self.text_font = font_index if font_index != 8 else 16
         if self.text_mode:
-            saved_text = self.text
-            self.delete_selection()
-            self.add_watermark_text(saved_text)
+            self.restyle_selection()
 
     def set_text_size(self, size_index):
         self.text_size = size_index + 1
         if self.text_mode:
-            saved_text = self.text
-            self.delete_selection()
-            self.add_watermark_text(saved_text)
+            self.restyle_selection()
 
     def set_text_color(self):
         self.text_color = QColorDialog().getColor(QColor(0, 0, 255)).getRgb()[:3][::-1]
         self.color_picker.setIcon(
             QIcon(self.ui.to_pixmap(np.full((40, 40, 3), self.text_color, dtype=np.uint8))))
         if self.text_mode:
-            saved_text = self.text
-            self.delete_selection()
-            self.add_watermark_text(saved_text)
+            self.restyle_selection()
 
     def set_text_bold(self):
         if self.text_bold:
@@ -351,11 +591,14 @@ class Core(QMainWindow):
             self.sender().setStyleSheet('background-color:#92DCFF;border-radius:5px')
             self.text_bold = True
         if self.text_mode:
-            saved_text = self.text
-            self.delete_selection()
-            self.add_watermark_text(saved_text)
+            self.restyle_selection()
 
     def delete_selection(self):
+        if self.selection is not None:
+            self.history.record('delete', len(self.watermark_objects) - 1, self.watermark_objects[-1], None)
+        self.remove_selection()
+
+    def remove_selection(self):
         if self.selection is not None:
             self.text = 'text'
             self.text_mode = None
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import cv2
+import numpy as np
+
+
+def read_into(image_path, buffer):
+    """ Decode an image into a buffer of its shape, getting the buffer, a new array if the shape was off, or None. """
+    try:
+        # OpenCV decodes straight into the buffer when it has the expected shape
+        image = cv2.imread(image_path, buffer, cv2.IMREAD_COLOR)
+    except (cv2.error, TypeError):
+        image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    return buffer if image is not None and np.shares_memory(image, buffer) else image
+
+
+class MappedImage:
+    """ A decoded image kept in a temporary memory-mapped file instead of process memory.
+
+    The operating system pages the pixels in and out of the backing file as they are touched, so a
+    very large image only costs resident memory for the parts that are being read or written.
+    """
+
+    def __init__(self, shape, folder=None):
+        descriptor, self.file_path = tempfile.mkstemp(prefix='pymark_', suffix='.raw', dir=folder)
+        os.close(descriptor)
+        self.array = np.memmap(self.file_path, dtype=np.uint8, mode='w+', shape=shape)
+
+    @classmethod
+    def read(cls, image_path, size, folder=None):
+        """ Decode an image of the given (width, height) into a mapped buffer, or get None if it cannot be read. """
+        mapped = cls((size[1], size[0], 3), folder)
+        image = read_into(image_path, mapped.array)
+        if image is mapped.array:
+            return mapped
+        mapped.close()
+        if image is None:
+            return None
+        # The header size was off (e.g. EXIF rotation), fall back to copying the decoded image
+        mapped = cls(image.shape, folder)
+        mapped.array[:] = image
+        return mapped
+
+    def close(self):
+        """ Unmap the buffer and delete its backing file. """
+        if self.array is not None:
+            # Dropping the last reference unmaps the file, which has to happen before it can be removed on Windows
+            self.array = None
+            os.remove(self.file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,17 @@
+from collections import deque
+
+
+def bounded_map(executor, function, items, window):
+    """ Map a function over items on an executor, keeping at most `window` tasks in flight.
+
+    Results are yielded in input order as soon as they are ready, and new items are only pulled
+    from `items` when a slot frees up, so lazily generated inputs are never materialized.
+    """
+    window = max(1, window)
+    pending = deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(function, item))
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,39 @@
+import time
+from PyQt5.QtCore import QObject, QTimer
+from PyQt5.QtGui import QGuiApplication
+
+
+class RenderScheduler(QObject):
+    """ Coalesce render requests so the render function runs at most once per display frame.
+
+    Only the arguments of the latest request are kept, so intermediate states produced faster than the
+    display can show them are skipped instead of queued.
+    """
+
+    def __init__(self, render, refresh_rate=None):
+        super().__init__()
+        screen = QGuiApplication.primaryScreen()
+        refresh_rate = refresh_rate or (screen.refreshRate() if screen else 0) or 60
+        self.interval = 1 / refresh_rate
+        self.render = render
+        self.pending = None
+        self.last_render = 0
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
+
+    def request(self, *args):
+        """ Ask for a render with the given arguments, replacing any request not rendered yet. """
+        self.pending = args
+        if not self.timer.isActive():
+            # Render right away when idle, otherwise wait for the rest of the current frame
+            delay = self.interval - (time.perf_counter() - self.last_render)
+            self.timer.start(max(0, int(delay * 1000)))
+
+    def flush(self):
+        """ Run the latest pending render now. """
+        self.timer.stop()
+        if self.pending is not None:
+            args, self.pending = self.pending, None
+            self.last_render = time.perf_counter()
+            self.render(*args)
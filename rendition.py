@@ -0,0 +1,62 @@
+from image_encoder import ImageEncoder
+
+
+class Rendition:
+    """ One of the outputs made of every exported image, e.g. a full-size master, a web size or a thumbnail.
+
+    Images are fitted inside `size` with their aspect ratio kept and are never enlarged, a rendition
+    without a size keeps the source resolution. The watermark is drawn the way a native export draws
+    it at that size, times `watermark_scale`. Each rendition is written to a subfolder of its name.
+    """
+
+    def __init__(self, name, size=None, format='png', quality=None, watermark_scale=1.0):
+        if not name or '/' in name or '\\' in name or name.startswith('.'):
+            raise ValueError(f'Invalid rendition name: {name!r}')
+        if size and min(size) < 1:
+            raise ValueError(f'Rendition size must be positive: {size}')
+        if watermark_scale <= 0:
+            raise ValueError(f'Watermark scale must be positive: {watermark_scale}')
+        self.name = name
+        self.size = tuple(size) if size else None
+        self.encoder = ImageEncoder(format, quality)
+        self.watermark_scale = watermark_scale
+
+    @classmethod
+    def parse(cls, spec):
+        """ Create a rendition from NAME:SIZE[:FORMAT[:QUALITY[:SCALE]]], SIZE being WIDTHxHEIGHT or full. """
+        fields = spec.split(':')
+        if not 2 <= len(fields) <= 5:
+            raise ValueError(f'Rendition must be NAME:SIZE[:FORMAT[:QUALITY[:SCALE]]], got {spec!r}')
+        name, size, format, quality, scale = fields + [None] * (5 - len(fields))
+        try:
+            size = None if size.lower() == 'full' else tuple(int(side) for side in size.lower().split('x'))
+            if size is not None and len(size) != 2:
+                raise ValueError
+            return cls(name, size, format or 'png', int(quality) if quality else None,
+                       float(scale) if scale else 1.0)
+        except ValueError as error:
+            raise ValueError(f'Invalid rendition {spec!r}: {str(error) or "size must be WIDTHxHEIGHT or full"}')
+
+    @classmethod
+    def parse_all(cls, specs):
+        """ Create the renditions of several specs, which must not share a name and so an output folder. """
+        renditions = [cls.parse(spec) for spec in specs]
+        names = set()
+        for rendition in renditions:
+            # Compared without case, as folder names are on Windows and macOS
+            if rendition.name.lower() in names:
+                raise ValueError(f'Rendition name {rendition.name!r} is used more than once')
+            names.add(rendition.name.lower())
+        return renditions
+
+    @property
+    def settings(self):
+        """ Get the settings that affect the rendition's output. """
+        return {**self.encoder.settings, 'size': self.size, 'watermark_scale': self.watermark_scale}
+
+    def output_size(self, width, height):
+        """ Get the size of this rendition of a (width, height) image. """
+        if not self.size:
+            return width, height
+        factor = min(self.size[0] / width, self.size[1] / height, 1)
+        return max(1, round(width * factor)), max(1, round(height * factor))
@@ -0,0 +1,327 @@
+import os
+import sys
+import json
+import glob
+import time
+import asyncio
+import argparse
+import threading
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from cv_manager import CVManager
+from image_encoder import ImageEncoder
+from layout import WatermarkLayout
+from image_stack import ImageStack
+
+CONTENT_TYPES = {'png': 'image/png', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ServiceStats:
+    """ Request counters and latency percentiles over the most recent `window` requests. """
+
+    def __init__(self, window=10000):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.failed = 0
+        self.rejected = 0
+        self.batches = 0
+        self.batched_images = 0
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def add(self, latency, ok):
+        with self.lock:
+            self.requests += 1
+            if ok:
+                self.latencies.append(latency)
+            else:
+                self.failed += 1
+
+    def add_batch(self, size):
+        with self.lock:
+            self.batches += 1
+            self.batched_images += size
+
+    def summary(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            summary = {'requests': self.requests, 'failed': self.failed, 'rejected': self.rejected,
+                       'uptime_sec': round(time.monotonic() - self.started, 1), 'batches': self.batches,
+                       'mean_batch_size': round(self.batched_images / self.batches, 2) if self.batches else 0}
+        for percentile in (50, 90, 99):
+            if latencies:
+                summary[f'latency_ms_p{percentile}'] = round(
+                    latencies[int(percentile / 100 * (len(latencies) - 1))] * 1000, 2)
+        return summary
+
+
+class WatermarkService:
+    """ Watermark images sent over HTTP with registered layouts.
+
+    POST /watermark/<layout id>[?format=jpeg&quality=90&native=1] with the image bytes as body
+    returns the watermarked image. GET /layouts lists layout ids, PUT /layouts/<layout id> registers
+    a layout saved from PyMark, and GET /stats returns counters and latency percentiles.
+
+    Images are watermarked on a thread pool (OpenCV releases the GIL) that shares one CVManager, so
+    a layout is compiled once per output size and stays warm for every later request. Requests that
+    arrive within `batch_delay` seconds of each other are handed to the pool together, up to
+    `batch_size` at a time, and drawn with CVManager.draw_batch into a per-thread ImageStack. With
+    more than `max_pending` requests waiting new ones are turned away with 503.
+    """
+
+    def __init__(self, layouts=None, workers=None, batch_size=8, batch_delay=0.002, max_pending=64,
+                 max_body=64 * 2 ** 20):
+        self.cv = CVManager(layer_cache_size=64)
+        self.layouts = dict(layouts or {})
+        self.workers = workers or os.cpu_count()
+        self.pool = ThreadPoolExecutor(self.workers)
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_pending = max_pending
+        self.max_body = max_body
+        self.encoders = {}
+        self.local = threading.local()
+        self.stats = ServiceStats()
+        self.pending = 0
+        self.jobs = None
+        self.slots = None
+        self.batcher = None
+
+    async def start(self, host='127.0.0.1', port=8765):
+        """ Start listening and return the asyncio server. Port 0 picks a free port. """
+        self.jobs = asyncio.Queue()
+        # At most one batch per worker thread is handed to the pool, the rest wait in the queue
+        self.slots = asyncio.Semaphore(self.workers)
+        self.batcher = asyncio.create_task(self.run_batches())
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def close(self):
+        if self.batcher:
+            self.batcher.cancel()
+        self.pool.shutdown(wait=True)
+
+    def encoder(self, format, quality):
+        key = (format, quality)
+        if key not in self.encoders:
+            self.encoders[key] = ImageEncoder(format, quality)
+        return self.encoders[key]
+
+    def decode(self, data):
+        if not data:
+            raise HTTPError(400, 'The body is empty, send the image as the body')
+        try:
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        except cv2.error:
+            image = None
+        if image is None:
+            raise HTTPError(400, 'The body is not an image OpenCV can decode')
+        return image
+
+    def watermark_batch(self, batch):
+        """ Watermark a batch of requests on a pool thread, drawing the images of each layout together. """
+        results = [None] * len(batch)
+        groups = {}
+        for index, (data, layout, encoder, native) in enumerate(batch):
+            try:
+                groups.setdefault((layout, native), []).append((index, self.decode(data)))
+            except Exception as error:
+                results[index] = error
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = ImageStack()
+        for (layout, native), items in groups.items():
+            try:
+                images = self.cv.draw_batch([image for _, image in items], layout, native, self.local.stack)
+            except Exception as error:
+                for index, _ in items:
+                    results[index] = error
+                continue
+            # The images are views into the thread's stack, so they are encoded before it is reused
+            for (index, _), image in zip(items, images):
+                try:
+                    results[index] = batch[index][2].encode(image)
+                except Exception as error:
+                    results[index] = error
+        return results
+
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Requests pile up while every worker is busy, then a free worker takes a batch of them
+            await self.slots.acquire()
+            batch = [await self.jobs.get()]
+            # A fair share of the queue, so the other workers are not left idle
+            size = min(self.batch_size, 1 + self.jobs.qsize() // self.workers)
+            deadline = loop.time() + self.batch_delay
+            while len(batch) < size:
+                try:
+                    batch.append(await asyncio.wait_for(self.jobs.get(), max(0, deadline - loop.time())))
+                except asyncio.TimeoutError:
+                    break
+            self.stats.add_batch(len(batch))
+            future = loop.run_in_executor(self.pool, self.watermark_batch, [job[:4] for job in batch])
+            future.add_done_callback(lambda future, batch=batch: self.finish_batch(batch, future))
+
+    def finish_batch(self, batch, future):
+        self.slots.release()
+        try:
+            results = future.result()
+        except Exception as error:
+            # The whole batch failed, e.g. the pool shut down, so every request waiting on it fails
+            results = [error] * len(batch)
+        for job, result in zip(batch, results):
+            if not job[4].done():
+                if isinstance(result, Exception):
+                    job[4].set_exception(result)
+                else:
+                    job[4].set_result(result)
+
+    async def submit(self, data, layout, encoder, native):
+        if self.pending >= self.max_pending:
+            self.stats.rejected += 1
+            raise HTTPError(503, 'Too many requests waiting, try again later')
+        self.pending += 1
+        try:
+            result = asyncio.get_running_loop().create_future()
+            await self.jobs.put((data, layout, encoder, native, result))
+            return await result
+        finally:
+            self.pending -= 1
+
+    async def route(self, method, target, body):
+        """ Get the (content type, body) of the response to a request. """
+        url = urlsplit(target)
+        parts = [part for part in url.path.split('/') if part]
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if parts == ['stats'] and method == 'GET':
+            return 'application/json', json.dumps(self.stats.summary()).encode()
+        if parts == ['layouts'] and method == 'GET':
+            return 'application/json', json.dumps(sorted(self.layouts)).encode()
+        if len(parts) == 2 and parts[0] == 'layouts' and method == 'PUT':
+            try:
+                data = json.loads(body)
+                if not isinstance(data, dict):
+                    raise ValueError('the body must be a JSON object')
+                self.layouts[parts[1]] = WatermarkLayout.from_dict(data)
+            except (ValueError, KeyError, TypeError) as error:
+                raise HTTPError(400, f'Invalid layout: {error}')
+            return 'application/json', json.dumps({'layout': parts[1]}).encode()
+        if len(parts) == 2 and parts[0] == 'watermark':
+            if method != 'POST':
+                raise HTTPError(405, 'Use POST with the image as the body')
+            layout = self.layouts.get(parts[1])
+            if layout is None:
+                raise HTTPError(404, f'Unknown layout: {parts[1]}')
+            try:
+                quality = int(query['quality']) if 'quality' in query else None
+                encoder = self.encoder(query.get('format', 'png'), quality)
+            except ValueError as error:
+                raise HTTPError(400, str(error))
+            data = await self.submit(body, layout, encoder, query.get('native') in ('1', 'true'))
+            return CONTENT_TYPES[encoder.format], data
+        raise HTTPError(404, f'Not found: {url.path}')
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                length = int(headers.get('content-length', 0))
+                if length > self.max_body:
+                    await self.respond(writer, 413, 'text/plain', b'Image too large', False)
+                    break
+                body = await reader.readexactly(length)
+                start = time.perf_counter()
+                try:
+                    content_type, payload = await self.route(method, target, body)
+                    status = 200
+                except HTTPError as error:
+                    status, content_type, payload = error.status, 'text/plain', str(error).encode()
+                except Exception as error:
+                    # Bad requests raise HTTPError, anything else is a failure of the service
+                    status, content_type, payload = 500, 'text/plain', str(error).encode()
+                if method == 'POST':
+                    self.stats.add(time.perf_counter() - start, status == 200)
+                await self.respond(writer, status, content_type, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, content_type, payload, keep_alive, chunk_size=2 ** 16):
+        writer.write(f'HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: {content_type}\r\n'
+                     f'Content-Length: {len(payload)}\r\nConnection: {"keep-alive" if keep_alive else "close"}'
+                     f'\r\n\r\n'.encode('latin-1'))
+        # Large images go out in chunks, as fast as the client reads them
+        view = memoryview(payload)
+        for offset in range(0, len(view), chunk_size):
+            writer.write(view[offset:offset + chunk_size])
+            await writer.drain()
+        await writer.drain()
+
+
+def load_layouts(folder):
+    """ Load every layout file in a folder, keyed by its file name without the extension. """
+    return {os.path.splitext(os.path.basename(path))[0]: WatermarkLayout.load(path)
+            for path in glob.glob(os.path.join(folder, '*.pmk'))}
+
+
+async def serve(service, host, port):
+    server = await service.start(host, port)
+    print(f'Serving {len(service.layouts)} layouts on http://{host}:{server.sockets[0].getsockname()[1]}',
+          flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve PyMark watermarking over HTTP on this machine.')
+    parser.add_argument('--layouts', default='.', help='folder of layout files saved from PyMark')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on, 0 for any free port')
+    parser.add_argument('--workers', type=int, default=None, help='watermarking threads (default: cores)')
+    parser.add_argument('--batch-size', type=int, default=8, help='most images handed to a worker at once')
+    parser.add_argument('--batch-delay-ms', type=float, default=2,
+                        help='how long to wait for more requests to batch with')
+    parser.add_argument('--max-pending', type=int, default=64, help='requests allowed to wait before 503')
+    args = parser.parse_args(argv)
+    try:
+        layouts = load_layouts(args.layouts)
+    except (OSError, ValueError) as error:
+        parser.error(f'cannot load the layouts: {error}')
+    service = WatermarkService(layouts, args.workers, args.batch_size, args.batch_delay_ms / 1000,
+                               args.max_pending)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
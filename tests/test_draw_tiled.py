@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from benchmark import synthetic_image, synthetic_layout, CANVAS_SIZE
+from cv_manager import CVManager
+from layout import WatermarkLayout, TextWatermark
+
+# Overlapping italic and bold text in several colours, besides the benchmark layouts
+OVERLAPPING_TEXT = [TextWatermark('Wy@gq|', (97, 60, 88), 18, 1, True, ((0.1, 0.2), (0.3, 0.35))),
+                    TextWatermark('(c) Photo 2024', (200, 180, 20), 2, 3, False, ((0.15, 0.25), (0.35, 0.4))),
+                    TextWatermark('PyMark', (255, 255, 255), 5, 4, True, ((0.05, 0.5), (0.25, 0.65)))]
+LAYOUTS = [WatermarkLayout.from_objects(synthetic_layout('text'), CANVAS_SIZE),
+           WatermarkLayout.from_objects(synthetic_layout('mixed'), CANVAS_SIZE, 3),
+           WatermarkLayout(OVERLAPPING_TEXT, CANVAS_SIZE, 2)]
+
+
+@pytest.mark.parametrize('layout', LAYOUTS)
+@pytest.mark.parametrize('width, height', [(1500, 1000), (2333, 1207), (3100, 2950), (4096, 1700)])
+def test_tiled_matches_native(layout, width, height):
+    # Tiles this small put seams through every text
+    image = synthetic_image(width, height)
+    native = CVManager().draw_layout(image.copy(), layout, native=True)
+    for tile_size in (64, 257):
+        tiled = CVManager(tile_size=tile_size).draw_tiled(image.copy(), layout)
+        assert np.array_equal(tiled, native), f'tile size {tile_size}'
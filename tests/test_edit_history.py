@@ -0,0 +1,100 @@
+import os
+import sys
+import subprocess
+import numpy as np
+import pytest
+from edit_history import EditHistory, OPERATION_BYTES
+from layout import TextWatermark, ImageWatermark
+
+# The editor is driven without a display
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+QtWidgets = pytest.importorskip('PyQt5.QtWidgets')
+
+
+@pytest.fixture(scope='module')
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+@pytest.fixture
+def core(app):
+    import main
+    return main.Core(app, 1000, 700, 'PyMark')
+
+
+def edit(core, kind, index, target, merge=False):
+    """ Change one layout entry on the editor and record it, as the editor's own edits do. """
+    before = None if kind == 'add' else core.watermark_objects[index]
+    core.apply_entry(index, before, target)
+    core.history.record(kind, index, before, target, merge)
+
+
+def snapshot(core):
+    return list(core.watermark_objects), core.watermark.copy()
+
+
+def test_undo_redo_round_trip(core):
+    logo = ImageWatermark(np.full((20, 40, 3), (40, 120, 200), dtype=np.uint8))
+    steps = [snapshot(core)]
+    edit(core, 'add', 0, (TextWatermark('PYMARK', (0, 0, 0), 0, 2, True), ((40, 40), (160, 50))))
+    steps.append(snapshot(core))
+    edit(core, 'add', 1, (logo, ((200, 60), (240, 80))))
+    steps.append(snapshot(core))
+    edit(core, 'move', 1, (logo, ((150, 30), (190, 50))))
+    steps.append(snapshot(core))
+    edit(core, 'delete', 0, None)
+    steps.append(snapshot(core))
+    for objects, canvas in reversed(steps[:-1]):
+        core.undo()
+        assert core.watermark_objects == objects
+        assert np.array_equal(core.watermark, canvas)
+    assert not core.history.can_undo
+    for objects, canvas in steps[1:]:
+        core.redo()
+        assert core.watermark_objects == objects
+        assert np.array_equal(core.watermark, canvas)
+    assert not core.history.can_redo
+
+
+def test_typing_merges_into_one_step(core):
+    position = ((40, 40), (160, 50))
+    edit(core, 'add', 0, (TextWatermark('', (0, 0, 0), 0, 1, False), position))
+    added = snapshot(core)
+    for text in ('P', 'PY', 'PYM'):
+        edit(core, 'restyle', 0, (TextWatermark(text, (0, 0, 0), 0, 1, False), position), merge=True)
+    typed = snapshot(core)
+    assert len(core.history.undo_stack) == 2
+    core.undo()
+    assert core.watermark_objects == added[0] and np.array_equal(core.watermark, added[1])
+    core.redo()
+    assert core.watermark_objects == typed[0] and np.array_equal(core.watermark, typed[1])
+
+
+def test_new_edit_clears_redo(core):
+    edit(core, 'add', 0, (TextWatermark('a', (0, 0, 0), 0, 1, False), ((40, 40), (60, 50))))
+    core.undo()
+    assert core.history.can_redo
+    edit(core, 'add', 0, (TextWatermark('b', (0, 0, 0), 0, 1, False), ((40, 40), (60, 50))))
+    assert not core.history.can_redo
+
+
+def test_editor_import_leaves_opencv_unloaded():
+    # OpenCV is loaded once the window is up, see Core.load_core
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', 'import sys, main; print("cv2" in sys.modules)'], cwd=root,
+                            capture_output=True, text=True, env={**os.environ, 'QT_QPA_PLATFORM': 'offscreen'})
+    assert result.stdout.strip() == 'False', result.stderr
+
+
+def test_shared_images_are_counted_once_and_trimmed():
+    logo = ImageWatermark(np.zeros((100, 100, 3), dtype=np.uint8))
+    history = EditHistory(max_bytes=logo.image.nbytes + 4 * OPERATION_BYTES)
+    history.record('add', 0, None, (logo, ((0, 0), (100, 100))))
+    for offset in range(1, 4):
+        history.record('move', 0, (logo, ((offset - 1, 0), (99 + offset, 100))),
+                       (logo, ((offset, 0), (100 + offset, 100))))
+    # Every operation holds the same image, which counts once
+    assert history.size == logo.image.nbytes + 4 * OPERATION_BYTES
+    history.record('move', 0, (logo, ((3, 0), (103, 100))), (logo, ((9, 0), (109, 100))))
+    assert len(history.undo_stack) == 4
+    assert history.size <= history.max_bytes
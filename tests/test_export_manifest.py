@@ -0,0 +1,90 @@
+import os
+import pytest
+from export_manifest import ExportManifest
+
+LAYOUT_HASH = 'layout'
+SETTINGS = {'format': 'png'}
+
+
+@pytest.fixture
+def folders(tmp_path):
+    sources, outputs = tmp_path / 'sources', tmp_path / 'outputs'
+    sources.mkdir()
+    outputs.mkdir()
+    # c has the same content as a
+    for name, content in (('a', b'first image'), ('b', b'second image'), ('c', b'first image')):
+        (sources / f'{name}.jpg').write_bytes(content)
+    return sources, outputs
+
+
+def items(sources, names='abc'):
+    return [(str(sources / f'{name}.jpg'), name) for name in names]
+
+
+def export(manifest, sources, names='abc'):
+    """ Write and record every output a plan asks for, like an export does. """
+    render, copies, skipped = manifest.plan(items(sources, names), LAYOUT_HASH, SETTINGS, '.png')
+    for _, name, key in render:
+        with open(manifest.output_path(name, '.png'), 'wb') as output_file:
+            output_file.write(b'watermarked')
+        manifest.record(name, '.png', key)
+    for name, source_name, key in copies:
+        manifest.copy(name, source_name, '.png', key)
+    manifest.save()
+    return render, copies, skipped
+
+
+def test_plan_on_empty_manifest(folders):
+    sources, outputs = folders
+    render, copies, skipped = ExportManifest(str(outputs)).plan(items(sources), LAYOUT_HASH, SETTINGS, '.png')
+    assert [name for _, name, _ in render] == ['a', 'b']
+    # The duplicate is copied from the first output with its content instead of rendered again
+    assert [(name, source_name) for name, source_name, _ in copies] == [('c', 'a')]
+    assert skipped == 0
+
+
+def test_skip_when_outputs_present(folders):
+    sources, outputs = folders
+    export(ExportManifest(str(outputs)), sources)
+    render, copies, skipped = ExportManifest(str(outputs)).plan(items(sources), LAYOUT_HASH, SETTINGS, '.png')
+    assert (render, copies, skipped) == ([], [], 3)
+
+
+def test_reexport_when_output_missing(folders):
+    sources, outputs = folders
+    export(ExportManifest(str(outputs)), sources)
+    os.remove(outputs / 'b.png')
+    render, copies, skipped = ExportManifest(str(outputs)).plan(items(sources), LAYOUT_HASH, SETTINGS, '.png')
+    assert [name for _, name, _ in render] == ['b']
+    assert (copies, skipped) == ([], 2)
+
+
+def test_reexport_when_settings_change(folders):
+    sources, outputs = folders
+    export(ExportManifest(str(outputs)), sources)
+    render, _, skipped = ExportManifest(str(outputs)).plan(items(sources), LAYOUT_HASH, {'format': 'jpeg'}, '.png')
+    assert [name for _, name, _ in render] == ['a', 'b']
+    assert skipped == 0
+
+
+def test_copy_for_duplicate_content(folders):
+    sources, outputs = folders
+    export(ExportManifest(str(outputs)), sources, 'ab')
+    (sources / 'd.jpg').write_bytes(b'second image')
+    manifest = ExportManifest(str(outputs))
+    render, copies, skipped = export(manifest, sources, 'abd')
+    assert render == []
+    assert [(name, source_name) for name, source_name, _ in copies] == [('d', 'b')]
+    assert skipped == 2
+    assert (outputs / 'd.png').read_bytes() == (outputs / 'b.png').read_bytes()
+    assert ExportManifest(str(outputs)).plan(items(sources, 'abd'), LAYOUT_HASH, SETTINGS, '.png')[2] == 3
+
+
+def test_unwritten_output_is_not_recorded(folders):
+    sources, outputs = folders
+    manifest = ExportManifest(str(outputs))
+    render, _, _ = manifest.plan(items(sources, 'a'), LAYOUT_HASH, SETTINGS, '.png')
+    # The write failed, so there is no file to record
+    manifest.record('a', '.png', render[0][2])
+    manifest.save()
+    assert ExportManifest(str(outputs)).outputs == {}
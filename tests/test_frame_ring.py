@@ -0,0 +1,69 @@
+import queue
+import multiprocessing
+import numpy as np
+import pytest
+from frame_ring import FrameRing
+
+
+@pytest.fixture
+def context():
+    # Spawned workers receive the ring pickled, which is how the pipeline hands it over on every platform
+    return multiprocessing.get_context('spawn')
+
+
+@pytest.fixture
+def ring(context):
+    frames = FrameRing(2, 64 * 48 * 3, context)
+    yield frames
+    frames.close(unlink=True)
+
+
+def fill(frames, descriptor, value):
+    frames.frame(descriptor)[:] = value
+    frames.release(descriptor[0])
+
+
+def test_fits(ring):
+    assert ring.fits((48, 64, 3))
+    assert ring.fits((10, 10, 3))
+    assert not ring.fits((49, 64, 3))
+    assert not ring.fits((48, 64, 3), np.uint16)
+
+
+def test_acquire_blocks_when_full(ring):
+    slots = {ring.acquire(), ring.acquire()}
+    assert slots == {0, 1}
+    with pytest.raises(queue.Empty):
+        ring.free.get(timeout=0.1)
+    ring.release(1)
+    assert ring.acquire() == 1
+
+
+def test_slots_do_not_overlap(ring):
+    first, second = ring.view(0, (48, 64, 3)), ring.view(1, (48, 64, 3))
+    first[:] = 1
+    second[:] = 2
+    assert (first == 1).all() and (second == 2).all()
+
+
+def test_descriptor_views_the_same_frame(ring):
+    slot = ring.acquire()
+    frame = ring.view(slot, (30, 40, 3))
+    frame[:] = 7
+    same = ring.frame(ring.descriptor(slot, frame))
+    assert same.shape == (30, 40, 3) and np.shares_memory(same, frame)
+    assert (same == 7).all()
+
+
+def test_frames_are_shared_with_other_processes(ring, context):
+    slot = ring.acquire()
+    frame = ring.view(slot, (48, 64, 3))
+    frame[:] = 0
+    process = context.Process(target=fill, args=(ring, ring.descriptor(slot, frame), 42))
+    process.start()
+    process.join(60)
+    assert process.exitcode == 0
+    # The worker wrote into the slot in place and handed it back
+    assert (frame == 42).all()
+    assert ring.acquire() in (0, 1)
+    frame = None
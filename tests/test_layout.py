@@ -0,0 +1,52 @@
+import json
+import numpy as np
+import pytest
+import batch
+import video
+import watch
+import service
+from layout import WatermarkLayout, TextWatermark, ImageWatermark
+
+BROKEN_LAYOUTS = {'not json': '{"version": ', 'not an object': '[]', 'no objects': None}
+
+
+def write_broken(path, kind):
+    content = BROKEN_LAYOUTS[kind]
+    if content is None:
+        content = json.dumps({k: v for k, v in WatermarkLayout([], (100, 100)).to_dict().items() if k != 'objects'})
+    path.write_text(content)
+    return str(path)
+
+
+def test_save_and_load_round_trip(tmp_path):
+    logo = np.full((10, 20, 3), (40, 120, 200), dtype=np.uint8)
+    layout = WatermarkLayout([TextWatermark('PYMARK', [0, 0, 0], 0, 2, True, ((0.1, 0.1), (0.5, 0.2))),
+                              ImageWatermark(logo, ((0.6, 0.6), (0.8, 0.7)))], (100, 100))
+    layout.save(tmp_path / 'layout.pmk')
+    loaded = WatermarkLayout.load(tmp_path / 'layout.pmk')
+    assert loaded.content_hash == layout.content_hash
+    assert np.array_equal(loaded.objects[1].image, logo)
+
+
+@pytest.mark.parametrize('kind', sorted(BROKEN_LAYOUTS))
+def test_load_rejects_files_that_are_not_layouts(tmp_path, kind):
+    with pytest.raises(ValueError, match='not a PyMark layout'):
+        WatermarkLayout.load(write_broken(tmp_path / 'layout.pmk', kind))
+
+
+@pytest.mark.parametrize('module', [batch, watch, video])
+@pytest.mark.parametrize('kind', ['missing', 'not json'])
+def test_commands_report_unreadable_layouts_as_argument_errors(tmp_path, capsys, module, kind):
+    path = str(tmp_path / 'layout.pmk') if kind == 'missing' else write_broken(tmp_path / 'layout.pmk', kind)
+    with pytest.raises(SystemExit) as exit_info:
+        module.main([str(tmp_path), path, '-o', str(tmp_path)])
+    assert exit_info.value.code == 2
+    assert 'cannot load the layout' in capsys.readouterr().err
+
+
+def test_service_reports_unreadable_layouts_as_argument_errors(tmp_path, capsys):
+    write_broken(tmp_path / 'broken.pmk', 'not an object')
+    with pytest.raises(SystemExit) as exit_info:
+        service.main(['--layouts', str(tmp_path)])
+    assert exit_info.value.code == 2
+    assert 'broken.pmk' in capsys.readouterr().err
@@ -0,0 +1,36 @@
+import pytest
+import batch
+from rendition import Rendition
+
+
+def test_parse():
+    rendition = Rendition.parse('web:1600x1200:jpeg:85:0.8')
+    assert (rendition.name, rendition.size, rendition.encoder.format, rendition.watermark_scale) == \
+        ('web', (1600, 1200), 'jpeg', 0.8)
+    assert Rendition.parse('master:full').size is None
+
+
+@pytest.mark.parametrize('spec', ['web', 'web:800', 'web:0x800', 'web:axb', '../web:800x800', 'web:800x800:gif'])
+def test_parse_rejects_invalid_specs(spec):
+    with pytest.raises(ValueError):
+        Rendition.parse(spec)
+
+
+def test_output_size_keeps_aspect_and_never_enlarges():
+    rendition = Rendition('web', (800, 800))
+    assert rendition.output_size(1600, 1200) == (800, 600)
+    assert rendition.output_size(400, 300) == (400, 300)
+
+
+@pytest.mark.parametrize('specs', [['web:800x800', 'web:100x100'], ['web:800x800', 'Web:full']])
+def test_duplicate_names_are_rejected(specs):
+    # Renditions of one name would write into the same folder and overwrite each other
+    with pytest.raises(ValueError, match='more than once'):
+        Rendition.parse_all(specs)
+
+
+def test_batch_rejects_duplicate_names(tmp_path, capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        batch.main([str(tmp_path), str(tmp_path / 'layout.pmk'), '-r', 'web:800x800', '-r', 'web:100x100'])
+    assert exit_info.value.code == 2
+    assert 'more than once' in capsys.readouterr().err
@@ -0,0 +1,55 @@
+import json
+import asyncio
+import cv2
+import numpy as np
+import pytest
+from benchmark import synthetic_layout, CANVAS_SIZE
+from layout import WatermarkLayout
+from service import WatermarkService
+
+
+def request(method, target, body=b''):
+    """ Send one request to a service on a free port and get the response status and body. """
+    async def send():
+        layout = WatermarkLayout.from_objects(synthetic_layout('text'), CANVAS_SIZE)
+        service = WatermarkService({'text': layout}, workers=1)
+        server = await service.start(port=0)
+        try:
+            reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+            writer.write(f'{method} {target} HTTP/1.1\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+                         .encode() + body)
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+        finally:
+            server.close()
+            await service.close()
+        head, _, payload = response.partition(b'\r\n\r\n')
+        return int(head.split()[1]), payload
+
+    return asyncio.run(send())
+
+
+def test_watermark():
+    image = np.full((300, 400, 3), 128, dtype=np.uint8)
+    status, payload = request('POST', '/watermark/text?format=png', cv2.imencode('.png', image)[1].tobytes())
+    assert status == 200
+    assert cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR) is not None
+
+
+@pytest.mark.parametrize('body', [b'', b'not an image'])
+def test_bad_image_is_a_client_error(body):
+    status, _ = request('POST', '/watermark/text', body)
+    assert status == 400
+
+
+@pytest.mark.parametrize('body', [b'[]', b'"x"', b'{}', b'not json'])
+def test_bad_layout_is_a_client_error(body):
+    status, _ = request('PUT', '/layouts/new', body)
+    assert status == 400
+
+
+def test_put_layout():
+    layout = WatermarkLayout.from_objects(synthetic_layout('mixed'), CANVAS_SIZE)
+    status, payload = request('PUT', '/layouts/new', json.dumps(layout.to_dict()).encode())
+    assert status == 200 and json.loads(payload) == {'layout': 'new'}
@@ -0,0 +1,45 @@
+import cv2
+import numpy as np
+from watermark_layer import WatermarkLayer, LayerCache
+
+
+class TextRenderer:
+    """ Measure and draw text through a bounded LRU cache of pre-rasterized text sprites.
+
+    A sprite is a string rendered once over black and over white into a WatermarkLayer whose offset
+    is relative to the text origin, so drawing a string that was drawn before is a single blend of
+    the pixels it covers.
+    """
+
+    def __init__(self, max_sprites=256):
+        self.sprites = LayerCache(max_sprites)
+
+    def measure(self, text, font, scale, thickness):
+        """ Get an (x, y, width, height) box relative to the text origin that the drawn text fits in. """
+        (width, height), baseline = cv2.getTextSize(text, font, scale, thickness)
+        # Leave room for strokes and italic slant that reach past the measured box
+        margin = thickness + height // 2
+        return -margin, -height - margin, width + 2 * margin, height + baseline + 2 * margin
+
+    def sprite(self, text, font, scale, color, thickness):
+        """ Get the sprite of a text style, rasterizing it only if it is not cached yet. """
+        key = (text, font, round(scale, 4), tuple(color), thickness)
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            x, y, width, height = self.measure(text, font, scale, thickness)
+            black = np.zeros((height, width, 3), dtype=np.uint8)
+            white = np.full_like(black, 255)
+            cv2.putText(black, text, (-x, -y), font, scale, color, thickness)
+            cv2.putText(white, text, (-x, -y), font, scale, color, thickness)
+            sprite = WatermarkLayer.from_renders(black, white, (x, y))
+            self.sprites.put(key, sprite)
+        return sprite
+
+    def text_rect(self, text, origin, font, scale, color, thickness):
+        """ Get the (x, y, width, height) of the pixels the text covers when drawn at origin. """
+        x, y, width, height = self.sprite(text, font, scale, color, thickness).rect
+        return origin[0] + x, origin[1] + y, width, height
+
+    def draw(self, image, text, origin, font, scale, color, thickness):
+        """ Draw text onto an image in place like cv2.putText, from its cached sprite. """
+        return self.sprite(text, font, scale, color, thickness).apply(image, origin)
@@ -1,8 +1,41 @@
-import cv2
-from cv_manager import CVManager
-from PyQt5.QtCore import QSize,Qt
-from PyQt5.QtGui import QIcon, QPixmap, QImage,QFont
-from PyQt5.QtWidgets import QPushButton, QWidget, QLabel, QHBoxLayout, QVBoxLayout, QListWidget,QComboBox,QRadioButton,QGroupBox
+import numpy as np
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QIcon, QPixmap, QImage,QFont, QPainter
+from PyQt5.QtWidgets import QPushButton, QWidget, QLabel, QHBoxLayout, QVBoxLayout, QListWidget,QComboBox,QRadioButton,QGroupBox, \
+    QProgressBar
+
+# Qt 5.14+ can show OpenCV's BGR layout directly, older versions need a channel swap
+BGR_FORMAT = getattr(QImage, 'Format_BGR888', None)
+
+
+class Canvas(QLabel):
+    # Label that paints from a persistent image buffer instead of a new QPixmap per frame
+    def __init__(self):
+        super().__init__()
+        self.buffer = None
+        self.image = None
+
+    # Copy an OpenCV image into the canvas buffer, optionally only the (x, y, width, height) rect of it
+    def set_image(self, image, rect=None):
+        if self.buffer is None or self.buffer.shape != image.shape:
+            # The QImage wraps the buffer without copying, so the buffer lives as long as the canvas
+            height, width, channels = image.shape
+            self.buffer = np.empty(image.shape, dtype=np.uint8)
+            self.image = QImage(self.buffer.data, width, height, width * channels,
+                                BGR_FORMAT if BGR_FORMAT is not None else QImage.Format_RGB888)
+            rect = None
+        x, y, width, height = rect or (0, 0, image.shape[1], image.shape[0])
+        source = image[y:y + height, x:x + width]
+        if BGR_FORMAT is None:
+            source = source[..., ::-1]
+        self.buffer[y:y + height, x:x + width] = source
+        self.update(x, y, width, height)
+
+    def paintEvent(self, event):
+        if self.image is None:
+            return super().paintEvent(event)
+        painter = QPainter(self)
+        painter.drawImage(event.rect(), self.image, event.rect())
 
 
 class UIManager:
@@ -47,10 +80,10 @@ class UIManager:
 
     # Create canvas widget for displaying images
     def create_canvas(self, layout, width, height, image):
-        canvas = QLabel()
+        canvas = Canvas()
         canvas.setFixedSize(width, height)
         canvas.setMouseTracking(True)
-        canvas.setPixmap(self.to_pixmap(image))
+        canvas.set_image(image)
 
         # Add canvas to the layout
         layout.addWidget(canvas)
@@ -93,9 +126,21 @@ class UIManager:
         buttons[-1].setChecked(True)
         return buttons
 
+    # Create progress bar widget, hidden until there is progress to show
+    def create_progress_bar(self, layout, width, height):
+        progress_bar = QProgressBar()
+        progress_bar.setFixedSize(width, height)
+        progress_bar.hide()
+
+        # Add progress bar to the layout
+        layout.addWidget(progress_bar)
+        return progress_bar
+
     # Convert OpenCV image to QPixmap
     def to_pixmap(self, image):
         height, width, channels = image.shape
+        if BGR_FORMAT is not None:
+            return QPixmap.fromImage(QImage(image.data, width, height, width * channels, BGR_FORMAT))
         # Convert BGR to RGB
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        image = np.ascontiguousarray(image[..., ::-1])
         return QPixmap(QImage(image.data, width, height, width * channels, QImage.Format_RGB888))
@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import cv2
+import numpy as np
+from cv_manager import CVManager
+from layout import WatermarkLayout
+from instrumentation import Instrumentation
+
+VIDEO_EXTENSIONS = ('.mp4', '.m4v', '.mov', '.avi', '.mkv', '.webm')
+# FourCC written into each output container unless one is given, containers missing here are written as .mp4
+VIDEO_CODECS = {'.mp4': 'mp4v', '.m4v': 'mp4v', '.mov': 'mp4v', '.avi': 'MJPG', '.mkv': 'XVID'}
+
+# Passed down the pipeline after the last frame
+END = None
+
+
+class VideoStats:
+    """ Frame counters of a video being watermarked. `frames` is only advanced by the encoding thread. """
+
+    def __init__(self, name, total=0):
+        self.name = name
+        self.total = total
+        self.frames = 0
+        self.started = time.monotonic()
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        fps = self.frames / elapsed if elapsed else 0
+        summary = {'video': self.name, 'frames': self.frames, 'total': self.total, 'fps': round(fps, 1),
+                   'elapsed_sec': round(elapsed, 2)}
+        if self.total and fps:
+            summary.update(percent=round(100 * min(self.frames / self.total, 1), 1),
+                           eta_sec=round(max(self.total - self.frames, 0) / fps, 1))
+        return summary
+
+
+def format_progress(summary):
+    if 'percent' in summary:
+        return (f'{summary["video"]}: {summary["frames"]}/{summary["total"]} frames ({summary["percent"]}%), '
+                f'{summary["fps"]} fps, eta {summary["eta_sec"]}s')
+    return f'{summary["video"]}: {summary["frames"]} frames, {summary["fps"]} fps'
+
+
+def collect_videos(sources):
+    """ Collect video paths from files and directories, in the order given. """
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            paths += sorted(os.path.join(source, name) for name in os.listdir(source)
+                            if name.lower().endswith(VIDEO_EXTENSIONS))
+        else:
+            paths.append(source)
+    return paths
+
+
+def output_path(folder, video_path):
+    """ Get the output path of a video, keeping its container when OpenCV can write it. """
+    name, extension = os.path.splitext(os.path.basename(video_path))
+    extension = extension.lower()
+    if extension not in VIDEO_CODECS:
+        extension = '.mp4'
+    return os.path.join(folder, name + extension)
+
+
+def watermark_video(cv, video_path, layout, path, fourcc=None, buffers=6, progress=None, interval=1.0, stop=None):
+    """ Watermark a video frame by frame into `path`, or get None if the video cannot be read.
+
+    Frames keep the source resolution and frame rate, and the watermark layer is compiled once for
+    that resolution, so each frame costs one blend of the watermarked band. Audio is not carried
+    over, OpenCV does not read it. Decoding and compositing run on their own threads while this
+    thread encodes, and frames travel through a pool of `buffers` preallocated frames, so the
+    three stages overlap and nothing is allocated per frame. `progress(stats)` is called about
+    every `interval` seconds and once at the end. Setting `stop` ends the video early. Returns
+    the run's VideoStats.
+    """
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        return None
+    width, height = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30
+    fourcc = fourcc or VIDEO_CODECS.get(os.path.splitext(path)[1].lower(), 'mp4v')
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+    if not writer.isOpened():
+        capture.release()
+        raise ValueError(f'Cannot write {path} with the {fourcc} codec')
+    layer = cv.compile_layer(layout, (width, height), cv.native_scale(width, height)) if layout.objects else None
+    stats = VideoStats(os.path.basename(video_path), max(int(capture.get(cv2.CAP_PROP_FRAME_COUNT)), 0))
+    stop = stop or threading.Event()
+    free, decoded, composited = queue.SimpleQueue(), queue.SimpleQueue(), queue.SimpleQueue()
+    for _ in range(max(2, buffers)):
+        free.put(np.empty((height, width, 3), dtype=np.uint8))
+    errors = []
+
+    def decode():
+        try:
+            while not stop.is_set():
+                frame = free.get()
+                with cv.instruments.stage('decode'):
+                    # Decodes into the pooled frame as long as the stream keeps its size
+                    read, frame = capture.read(frame)
+                if not read:
+                    break
+                decoded.put(frame)
+        except Exception as error:
+            errors.append(error)
+        finally:
+            decoded.put(END)
+
+    def composite():
+        while True:
+            frame = decoded.get()
+            if frame is END:
+                break
+            if layer is not None and not errors:
+                try:
+                    with cv.instruments.stage('composite'):
+                        layer.apply(frame)
+                except Exception as error:
+                    errors.append(error)
+                    stop.set()
+            composited.put(frame)
+        composited.put(END)
+
+    threads = [threading.Thread(target=decode, daemon=True), threading.Thread(target=composite, daemon=True)]
+    for thread in threads:
+        thread.start()
+    next_report = time.monotonic() + interval
+    finished = False
+    try:
+        while True:
+            frame = composited.get()
+            if frame is END:
+                finished = True
+                break
+            if not errors:
+                with cv.instruments.stage('encode'):
+                    writer.write(frame)
+                stats.frames += 1
+            free.put(frame)
+            if progress and time.monotonic() >= next_report:
+                progress(stats)
+                next_report = time.monotonic() + interval
+    finally:
+        if not finished:
+            stop.set()
+            # Keep handing frames back until the decoder notices the stop and the pipeline runs dry
+            frame = composited.get()
+            while frame is not END:
+                free.put(frame)
+                frame = composited.get()
+        for thread in threads:
+            thread.join()
+        capture.release()
+        writer.release()
+        # Only a stop request leaves a shortened video behind, an error leaves none
+        if errors or not finished:
+            os.remove(path)
+    if errors:
+        raise errors[0]
+    if progress:
+        progress(stats)
+    return stats
+
+
+def show_progress(stats):
+    print('\r' + format_progress(stats.summary()), end='', flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Watermark videos without the PyMark window.')
+    parser.add_argument('videos', nargs='+', help='video files or folders of videos to watermark')
+    parser.add_argument('layout', help='watermark layout file saved from PyMark')
+    parser.add_argument('-o', '--output', default='.', help='folder to create the PyMark output folder in')
+    parser.add_argument('--fourcc', default=None,
+                        help='codec of the output videos, e.g. mp4v or MJPG (default: by container)')
+    parser.add_argument('--buffers', type=int, default=6, help='frames in flight between the pipeline stages')
+    parser.add_argument('--stats', action='store_true', help='print per-stage timings as JSON at the end')
+    args = parser.parse_args(argv)
+    if args.fourcc and len(args.fourcc) != 4:
+        parser.error('--fourcc takes four characters')
+
+    try:
+        layout = WatermarkLayout.load(args.layout)
+    except (OSError, ValueError) as error:
+        parser.error(f'cannot load the layout: {error}')
+    cv = CVManager()
+    cv.instruments = Instrumentation(args.stats)
+    folder = cv.create_folder(args.output, reuse=True)
+    failed = 0
+    for video_path in collect_videos(args.videos):
+        path = output_path(folder, video_path)
+        try:
+            stats = watermark_video(cv, video_path, layout, path, args.fourcc, args.buffers, show_progress)
+        except KeyboardInterrupt:
+            print()
+            return 130
+        except ValueError as error:
+            failed += 1
+            print(error, file=sys.stderr)
+            continue
+        if stats is None:
+            failed += 1
+            print(f'Cannot read {video_path}', file=sys.stderr)
+        else:
+            print(f'\r{format_progress(stats.summary())}, saved to {path}')
+    if args.stats:
+        print(json.dumps(cv.instruments.summary(), indent=2))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
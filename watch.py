@@ -0,0 +1,174 @@
+import os
+import sys
+import time
+import queue
+import signal
+import argparse
+import threading
+import statistics
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from cv_manager import CVManager
+from image_encoder import ImageEncoder, ENCODER_FORMATS
+from layout import WatermarkLayout
+from folder_watcher import create_watcher
+from batch import IMAGE_EXTENSIONS, init_worker, watermark_file, available_cores
+
+
+class IngestStats:
+    """ Throughput and latency counters of a watch run.
+
+    Latency is measured from the moment a file is reported complete to the moment its watermarked
+    output is saved, over the most recent `window` images.
+    """
+
+    def __init__(self, window=1000):
+        self.started = time.monotonic()
+        self.saved = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def add(self, latency, saved):
+        with self.lock:
+            if saved:
+                self.saved += 1
+                self.latencies.append(latency)
+            else:
+                self.failed += 1
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            latencies = sorted(self.latencies)
+            saved, failed = self.saved, self.failed
+        summary = {'saved': saved, 'failed': failed, 'images_per_sec': round(saved / elapsed, 2) if elapsed else 0}
+        if latencies:
+            summary.update(latency_ms_p50=round(statistics.median(latencies) * 1000, 1),
+                           latency_ms_p95=round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 1),
+                           latency_ms_max=round(latencies[-1] * 1000, 1))
+        return summary
+
+
+def init_watch_worker(*initargs):
+    """ Set up a batch worker that leaves Ctrl+C to the watching process, which shuts the pool down. """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_worker(*initargs)
+
+
+def format_summary(summary):
+    text = f'{summary["saved"]} saved, {summary["failed"]} failed, {summary["images_per_sec"]} images/sec'
+    if 'latency_ms_p50' in summary:
+        text += (f', latency p50 {summary["latency_ms_p50"]} ms, p95 {summary["latency_ms_p95"]} ms, '
+                 f'max {summary["latency_ms_max"]} ms')
+    return text
+
+
+def watch(source, layout, folder, jobs=None, window=None, encoder_settings=None, native=False, tile_pixels=None,
+          existing=False, poll_interval=0.25, stats_interval=10, stop=None, stats=None):
+    """ Watermark images into `folder` as they land in `source`, until `stop` is set or the process is interrupted.
+
+    Files are picked up once they are completely written and processed on a process pool. At most
+    `window` images are in flight (default: two per worker); while the pool is full new files wait
+    to be submitted, and a file written again while it is being processed is processed once more
+    afterwards. Returns the run's IngestStats.
+    """
+    jobs = jobs or available_cores()
+    window = window or jobs * 2
+    stop = stop or threading.Event()
+    stats = stats or IngestStats()
+    slots = threading.BoundedSemaphore(window)
+    finished = queue.SimpleQueue()
+    landed = deque()
+    in_flight = set()
+    again = {}
+    watcher = create_watcher(source, poll_interval)
+    if existing:
+        now = time.monotonic()
+        landed.extend((os.path.join(source, name), now) for name in sorted(os.listdir(source)))
+
+    def done(path, start, future):
+        stats.add(time.monotonic() - start, future.exception() is None and future.result()[0] is not None)
+        slots.release()
+        finished.put(path)
+
+    initargs = (layout, folder, encoder_settings or {}, native, tile_pixels)
+    next_report = time.monotonic() + stats_interval
+    try:
+        with ProcessPoolExecutor(jobs, initializer=init_watch_worker, initargs=initargs) as pool:
+            # Start every worker now so the first image does not wait for a process to spawn
+            list(pool.map(abs, range(jobs)))
+            while not stop.is_set():
+                now = time.monotonic()
+                landed.extend((path, now) for path in watcher.wait(0.05 if landed else 0.2))
+                while not finished.empty():
+                    path = finished.get()
+                    in_flight.discard(path)
+                    if path in again:
+                        landed.append((path, again.pop(path)))
+                while landed:
+                    path, start = landed.popleft()
+                    if not path.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    if path in in_flight:
+                        again[path] = start
+                        continue
+                    # Backpressure: a full pool leaves the remaining files waiting here
+                    if not slots.acquire(timeout=0.05):
+                        landed.appendleft((path, start))
+                        break
+                    in_flight.add(path)
+                    pool.submit(watermark_file, path).add_done_callback(
+                        lambda future, path=path, start=start: done(path, start, future))
+                if stats_interval and time.monotonic() >= next_report:
+                    print(format_summary(stats.summary()), flush=True)
+                    next_report = time.monotonic() + stats_interval
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Watermark images as they are dropped into a folder.')
+    parser.add_argument('source', help='folder to watch')
+    parser.add_argument('layout', help='watermark layout file saved from PyMark')
+    parser.add_argument('-o', '--output', default='.', help='folder to create the PyMark output folder in')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: available cores)')
+    parser.add_argument('-w', '--window', type=int, default=None,
+                        help='images in flight at once (default: two per worker)')
+    parser.add_argument('-f', '--format', default='png', choices=[*ENCODER_FORMATS, 'jpg'], help='output format')
+    parser.add_argument('-q', '--quality', type=int, default=None,
+                        help='JPEG/WebP quality 0-100 or PNG compression level 0-9')
+    parser.add_argument('--native', action='store_true',
+                        help='keep the source resolution and only redraw the watermarked region')
+    parser.add_argument('--tile-megapixels', type=float, default=None,
+                        help='memory-map and tile images larger than this (default: 100)')
+    parser.add_argument('--existing', action='store_true', help='also watermark the images already in the folder')
+    parser.add_argument('--poll-interval', type=float, default=0.25,
+                        help='seconds between scans when inotify is not available')
+    parser.add_argument('--stats-interval', type=float, default=10, help='seconds between counter reports, 0 for none')
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.source):
+        parser.error(f'{args.source} is not a folder')
+    try:
+        encoder_settings = ImageEncoder(args.format, args.quality).settings
+    except ValueError as error:
+        parser.error(str(error))
+
+    try:
+        layout = WatermarkLayout.load(args.layout)
+    except (OSError, ValueError) as error:
+        parser.error(f'cannot load the layout: {error}')
+    folder = CVManager().create_folder(args.output, reuse=True)
+    print(f'Watching {args.source}, saving to {folder}. Press Ctrl+C to stop.', flush=True)
+    tile_pixels = args.tile_megapixels * 10 ** 6 if args.tile_megapixels else None
+    stats = watch(args.source, layout, folder, args.jobs, args.window, encoder_settings, args.native, tile_pixels,
+                  args.existing, args.poll_interval, args.stats_interval)
+    print(format_summary(stats.summary()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+import cv2
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+class WatermarkLayer:
+    """ A watermark layout pre-rendered for one output size.
+
+    `overlay` is a BGRA image with premultiplied colour, cropped to the pixels the layout paints, and
+    `offset` is where that crop sits in the output image, so applying the layer only touches the
+    watermarked region.
+    """
+    __slots__ = ('overlay', 'color', 'mask', 'inverse', 'offset', 'luminance')
+
+    def __init__(self, overlay, offset):
+        self.overlay = overlay
+        self.offset = offset
+        self.color = None
+        self.mask = None
+        self.inverse = None
+        self.luminance = 0
+        if overlay is not None:
+            # Contiguous colour planes keep the per-image blend free of strided copies
+            self.color = np.ascontiguousarray(overlay[..., :3])
+            alpha = overlay[..., 3]
+            self.mask = (alpha > 0).view(np.uint8)
+            # Mean luminance of the painted pixels, weighted by how much of each pixel they cover
+            coverage = int(alpha.sum(dtype=np.int64))
+            if coverage:
+                gray = cv2.cvtColor(self.color, cv2.COLOR_BGR2GRAY)
+                self.luminance = int(gray.sum(dtype=np.int64)) * 255 / coverage
+            # Fully opaque layers are applied with a masked copy, anti-aliased ones with an alpha blend
+            if not (alpha[alpha > 0] == 255).all():
+                self.inverse = np.repeat(255 - alpha[..., None], 3, axis=2)
+
+    @classmethod
+    def from_renders(cls, black, white, origin=(0, 0)):
+        """ Build a layer from the same layout rendered over a black and over a white background.
+
+        Over black a pixel is colour * alpha, over white it is colour * alpha + 255 * (1 - alpha), so
+        the two renders give the premultiplied colour and the alpha of every pixel. `origin` is where
+        the renders sit in the output image.
+        """
+        alpha = 255 - (white.astype(np.int16) - black).max(axis=2)
+        rows = np.flatnonzero(alpha.any(axis=1))
+        cols = np.flatnonzero(alpha.any(axis=0))
+        if not len(rows):
+            return cls(None, (0, 0))
+        crop = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+        overlay = np.dstack((black[crop], alpha[crop].astype(np.uint8)))
+        return cls(overlay, (origin[0] + int(cols[0]), origin[1] + int(rows[0])))
+
+    @property
+    def rect(self):
+        """ Get the (x, y, width, height) the layer covers in the output image. """
+        if self.overlay is None:
+            return 0, 0, 0, 0
+        return (*self.offset, self.overlay.shape[1], self.overlay.shape[0])
+
+    def apply(self, image, origin=(0, 0)):
+        """ Composite the layer onto a BGR image in place.
+
+        `origin` moves the layer by that much, and any part of it that falls outside the image is cut off.
+        """
+        self.apply_stack(image[np.newaxis], origin)
+        return image
+
+    def apply_stack(self, stack, origin=(0, 0), scratch=None):
+        """ Composite the layer onto every image of an (N, H, W, 3) stack of same-size images in place.
+
+        The region to touch is worked out once for the whole stack, then each image gets OpenCV's
+        fused 8-bit masked copy or blend, which outruns multi-pass NumPy arithmetic over the stack.
+        `scratch` is optional flat uint8 working space of at least one watermarked region.
+        """
+        if self.overlay is not None:
+            x, y, width, height = self.rect
+            x, y = x + origin[0], y + origin[1]
+            x0, y0 = max(x, 0), max(y, 0)
+            x1, y1 = min(x + width, stack.shape[2]), min(y + height, stack.shape[1])
+            if x1 <= x0 or y1 <= y0:
+                return stack
+            crop = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+            color = self.color[crop]
+            if self.inverse is None:
+                mask = self.mask[crop]
+                for roi in stack[:, y0:y1, x0:x1]:
+                    cv2.copyTo(color, mask, roi)
+                return stack
+            if scratch is None or scratch.size < color.size:
+                scratch = np.empty(color.size, dtype=np.uint8)
+            product = scratch[:color.size].reshape(color.shape)
+            inverse = self.inverse[crop]
+            for roi in stack[:, y0:y1, x0:x1]:
+                # roi * (255 - alpha) / 255 + premultiplied colour, rounded like integer math would
+                cv2.multiply(roi, inverse, dst=product, scale=1 / 255)
+                cv2.add(product, color, dst=roi)
+        return stack
+
+
+class LayerCache:
+    """ Thread-safe LRU cache of compiled watermark layers. """
+
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self.layers = OrderedDict()
+        self.lock = threading.Lock()
+        # Per-key locks of the layers being compiled right now
+        self.compiling = {}
+
+    def get(self, key):
+        with self.lock:
+            layer = self.layers.get(key)
+            if layer is not None:
+                self.layers.move_to_end(key)
+            return layer
+
+    def get_or_compile(self, key, compile):
+        """ Get a layer, calling `compile` to make it if it is missing. Threads missing the same key share one compile. """
+        layer = self.get(key)
+        if layer is None:
+            with self.lock:
+                key_lock = self.compiling.setdefault(key, threading.Lock())
+            with key_lock:
+                layer = self.get(key)
+                if layer is None:
+                    layer = compile()
+                    self.put(key, layer)
+            with self.lock:
+                self.compiling.pop(key, None)
+        return layer
+
+    def put(self, key, layer):
+        with self.lock:
+            self.layers[key] = layer
+            self.layers.move_to_end(key)
+            while len(self.layers) > self.max_size:
+                self.layers.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.layers.clear()
+